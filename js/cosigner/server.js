@@ -148,6 +148,19 @@ function setup(db) {
     });
   });
 
+  /**
+   * Report whether this cosigner can reach its database.
+   */
+  app.get('/health', function(req, res) {
+    db.command({ping: 1}, function(err) {
+      if (err) {
+        console.error(err);
+        return res.status(503).json(error.fail('database unavailable'));
+      }
+      return res.json({ok: true});
+    });
+  });
+
   app.listen(port, hostname, function() {
     console.log('Listening on http://' + hostname + ':' + port);
   });
@@ -3,7 +3,7 @@ from setuptools import setup
 
 requires = [
     "supervisor", "gunicorn", "gevent",
-    "flask-restful", "flask-login", "flask-cors", "sqlalchemy>=1.0.9",
+    "flask-restful", "flask-login", "flask-cors", "sqlalchemy>=1.2",
     "bitjws==0.6.3.1", "entropy"
 ]
 if sys.version_info < (3, 5):
@@ -0,0 +1,124 @@
+"""
+Addresses derived ahead of time for server-cosigned wallets, so handing
+one out is a local database operation instead of a cosigner round trip.
+"""
+import uuid
+import logging
+import threading
+
+from . import database as db
+from .constant import MAX_NEWADDRESS
+
+__all__ = ['AddressPool', 'path_index']
+
+
+def path_index(path):
+    """Return the last index of a derivation path like m/0/12."""
+    return int(path.rsplit('/', 1)[-1])
+
+
+class AddressPool(object):
+    """
+    Keep up to size unused addresses per CosignerWallet in the
+    cosigner_address table. Once fewer than low_water remain, a
+    background task derives more.
+    """
+
+    def __init__(self, app, size=20, low_water=5):
+        self.app = app
+        self.size = size
+        self.low_water = low_water
+        self._refilling = set()
+        self._lock = threading.Lock()
+
+    def take(self, record, num):
+        """
+        Issue up to num unused addresses of the CosignerWallet record,
+        lowest path first. Fewer are returned if the pool runs short.
+        """
+        session = self.app.session
+        # Select the ids first: MySQL allows neither LIMIT in an IN
+        # subquery nor one reading the table being updated.
+        unused = [row.id for row in session.query(
+            db.CosignerAddress.id).filter(
+                db.CosignerAddress.cosigner_id == record.id,
+                db.CosignerAddress.issued_at == None).order_by(
+                    db.CosignerAddress.path_index).limit(num)]
+        # Checking issued_at again makes concurrent requests skip the
+        # rows already claimed by another one.
+        token = str(uuid.uuid4())
+        if unused:
+            session.query(db.CosignerAddress).filter(
+                db.CosignerAddress.id.in_(unused),
+                db.CosignerAddress.issued_at == None).update(
+                    {'issued_at': db.func.now(), 'claim': token},
+                    synchronize_session=False)
+        session.commit()
+
+        taken = session.query(db.CosignerAddress).filter(
+            db.CosignerAddress.claim == token).order_by(
+                db.CosignerAddress.path_index).all()
+        left = session.query(db.CosignerAddress).filter(
+            db.CosignerAddress.cosigner_id == record.id,
+            db.CosignerAddress.issued_at == None).count()
+        if left < self.low_water:
+            self.refill_async(record.wallet_id, self.app.current_shard())
+
+        return [{'address': entry.address, 'path': entry.path,
+                 'createdOn': entry.created_on} for entry in taken]
+
+    def refill_async(self, wallet_id, shard=0):
+        """Top up the pool of wallet_id, kept in shard, in the background."""
+        with self._lock:
+            if wallet_id in self._refilling:
+                return
+            self._refilling.add(wallet_id)
+        thread = threading.Thread(target=self._refill,
+                                  args=(wallet_id, shard))
+        thread.daemon = True
+        thread.start()
+
+    def _refill(self, wallet_id, shard):
+        try:
+            with self.app.app_context():
+                self.app.use_shard(shard)
+                self.refill(wallet_id)
+        except Exception:
+            logging.exception("Failed to refill addresses for {}".format(
+                wallet_id))
+        finally:
+            self.app.session.remove()
+            with self._lock:
+                self._refilling.discard(wallet_id)
+
+    def refill(self, wallet_id):
+        session = self.app.session
+        record = session.query(db.CosignerWallet).filter(
+            db.CosignerWallet.wallet_id == wallet_id).one_or_none()
+        if record is None:
+            return
+        left = session.query(db.CosignerAddress).filter(
+            db.CosignerAddress.cosigner_id == record.id,
+            db.CosignerAddress.issued_at == None).count()
+        num = min(self.size - left, MAX_NEWADDRESS)
+        if num <= 0:
+            return
+
+        resp = self.app.cosigner('/address/new', num=num, wallet=record.wallet)
+        if resp is None or 'address' not in resp:
+            logging.error(resp)
+            return
+        derived = resp['address']
+        if isinstance(derived, dict):
+            derived = [derived]
+
+        session.add_all(
+            db.CosignerAddress(cosigner_id=record.id,
+                               address=entry['address'],
+                               path=entry['path'],
+                               path_index=path_index(entry['path']),
+                               created_on=entry.get('createdOn'))
+            for entry in derived)
+        session.commit()
+        logging.info("Derived {} addresses for {}".format(
+            len(derived), wallet_id))
@@ -2,16 +2,23 @@ import os
 import base64
 import random
 import logging
+from collections import namedtuple
 
-import bitjws
-from flask import Response, current_app, g
+from flask import Response, current_app, g, has_app_context
 from flask.ext.login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 
 from . import database as db
 from .error import Errors
+from .offload import PoolBusy
 
 TOTP_ISSUER = 'Deglet'
 
+# What authenticate needs to know about a key, as kept in the key cache.
+CachedKey = namedtuple('CachedKey',
+                       'id user_id username key_type deactivated shard')
+
 
 class User(UserMixin):
     def __init__(self, id, username, address):
@@ -40,28 +47,110 @@ def authenticate(request):
     g.payload = resp['data']
 
     publickey = resp['header']['kid'].encode('ascii')
-    userkey = current_app.session.query(db.UserKey).filter(
-        db.UserKey.key == publickey).one_or_none()
+    userkey = lookup_key(publickey)
     if userkey is None:
         # No user found.
         logging.error("No user found for key {}".format(publickey))
         g.auth_err = current_app.encode_error(Errors.UserNotFound, 401)
         return None
+    if userkey.deactivated:
+        logging.error("Key {} or its user is deactivated".format(publickey))
+        g.auth_err = current_app.encode_error(Errors.UserNotFound, 401)
+        return None
 
-    # Check last nonce used.
+    # Everything else in this request is about this user, on their shard.
+    current_app.use_shard(userkey.shard)
+
+    # Check last nonce used, the guard also records it if accepted.
     nonce = int(resp['data'].get('iat', 0))
-    if nonce <= userkey.last_nonce:
-        logging.error("Nonce {} is not greater than the last one {}".format(
-            nonce, userkey.last_nonce))
+    if not current_app.nonce_guard.accept(userkey, nonce):
+        logging.error("Nonce {} is not greater than the last one for "
+                      "key {}".format(nonce, publickey))
         g.auth_err = current_app.encode_error(Errors.InvalidNonce, 401)
         return None
 
-    # Update last nonce.
-    userkey.last_nonce = nonce
-    current_app.session.add(userkey)
-    current_app.session.commit()
+    return User(userkey.user_id, userkey.username, publickey)
+
+
+def lookup_key(publickey):
+    """
+    Return a CachedKey for publickey, or None if the key is unknown.
+    Known keys are served from current_app.key_cache when possible.
+    """
+    cache = current_app.key_cache
+    entry = cache.get(publickey)
+    if entry is not None:
+        return entry
+
+    shard = 0
+    if current_app.directory is not None:
+        shard = current_app.directory.key_shard(publickey)
+        if shard is None:
+            return None
+        current_app.use_shard(shard)
+
+    row = current_app.session.query(
+        db.UserKey.id, db.UserKey.user_id, db.User.username,
+        db.UserKey.key_type, db.UserKey.deactivated_at,
+        db.User.deactivated_at).join(db.UserKey.user).filter(
+            db.UserKey.key == publickey).one_or_none()
+    if row is None:
+        return None
+
+    key_id, user_id, username, key_type, key_off, user_off = row
+    entry = CachedKey(key_id, user_id, username, key_type,
+                      key_off is not None or user_off is not None, shard)
+    cache.set(publickey, entry)
+    return entry
+
+
+# Columns kept in CachedKey entries, see lookup_key.
+KEY_COLUMNS = {
+    db.UserKey: {'id', 'key', 'user_id', 'key_type', 'deactivated_at'},
+    db.User: {'id', 'username', 'deactivated_at'},
+}
+
+
+def _key_cache():
+    # Writes made outside of an app, like sw.shard moves, have no cache
+    # to keep in step.
+    return current_app.key_cache if has_app_context() else None
+
+
+def _key_changed(mapper, connection, target):
+    cache = _key_cache()
+    if cache is not None:
+        cache.discard(target.key)
+
+
+def _user_changed(mapper, connection, target):
+    cache = _key_cache()
+    if cache is not None:
+        # User ids are only unique within a shard, so this may drop the
+        # keys of users on other shards too.
+        cache.discard_where(lambda entry: entry.user_id == target.id)
+
+
+def _keys_bulk_changed(context):
+    columns = KEY_COLUMNS.get(context.mapper.class_)
+    changed = db.bulk_changes(context)
+    cache = _key_cache()
+    if columns and cache is not None and (changed is None or
+                                          changed & columns):
+        # The rows are not known, so drop every key.
+        cache.clear()
+
 
-    return User(userkey.user.id, userkey.user.username, publickey)
+# Keep the key cache of the current app consistent with the writes of
+# this process: any change to a UserKey or User drops the affected
+# entries. Changes made by other processes, a key deactivated by another
+# worker included, are only picked up once the entries expire, so they
+# can take up to the auth_cache ttl to apply.
+for name in ('after_update', 'after_delete'):
+    event.listen(db.UserKey, name, _key_changed)
+    event.listen(db.User, name, _user_changed)
+event.listen(Session, 'after_bulk_update', _keys_bulk_changed)
+event.listen(Session, 'after_bulk_delete', _keys_bulk_changed)
 
 
 def unauthorized():
@@ -79,7 +168,10 @@ def jws_preprocessor(request, status=400):
     data = request.data.encode('utf8')
 
     try:
-        header, payload = bitjws.validate_deserialize(data, requrl=url)
+        header, payload = current_app.verify(data, url)
+    except PoolBusy:
+        logging.error("Too many messages waiting for validation")
+        return current_app.encode_error(Errors.ServerBusy, 503)
     except Exception:
         logging.exception("Failed to validate and deserialize message")
         return current_app.encode_error(Errors.InvalidMessage, status)
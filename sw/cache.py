@@ -0,0 +1,161 @@
+"""
+Caches shared by every request handled by a worker.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+__all__ = ['LRUCache', 'LoadingCache']
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that evicts the least recently used entry once
+    maxsize is reached. Entries older than ttl seconds are treated as
+    missing, so anything stored here is stale for at most ttl seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return default
+            # Re-insert it so it becomes the most recently used entry.
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key, default=None):
+        """Like get, but leaves the hit counts and the LRU order alone."""
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.time():
+            return default
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard_where(self, predicate):
+        """Drop every entry whose value satisfies predicate."""
+        with self._lock:
+            stale = [key for key, (_, value) in self._data.items()
+                     if predicate(value)]
+            for key in stale:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits,
+                'misses': self.misses}
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class LoadingCache(object):
+    """
+    Cache the values produced by a loader in a store (see sw.store).
+
+    Concurrent misses for the same key in this process share a single
+    call to the loader. With stale_ttl, a value up to stale_ttl seconds
+    past its ttl is still returned while one background call refreshes
+    it. Values must be JSON serializable; only those accepted by keep
+    are stored.
+    """
+
+    def __init__(self, store, prefix, ttl=10, stale_ttl=0):
+        self.store = store
+        self.prefix = prefix
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader, keep=lambda value: value is not None):
+        entry = self.store.get(self.prefix + key)
+        if entry is not None:
+            age = time.time() - entry['at']
+            if age < self.ttl:
+                self.hits += 1
+                return entry['value']
+            if age < self.ttl + self.stale_ttl:
+                self.stale += 1
+                self._refresh(key, loader, keep)
+                return entry['value']
+        self.misses += 1
+        return self._load(key, loader, keep)
+
+    def discard(self, key):
+        self.store.delete(self.prefix + key)
+
+    def _refresh(self, key, loader, keep):
+        if key in self._flights:
+            return
+        thread = threading.Thread(target=self._load, args=(key, loader, keep))
+        thread.daemon = True
+        thread.start()
+
+    def _load(self, key, loader, keep):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+            if keep(flight.value):
+                entry = {'at': time.time(), 'value': flight.value}
+                self.store.set(self.prefix + key, entry,
+                               self.ttl + self.stale_ttl)
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'stale': self.stale, 'loading': len(self._flights)}
@@ -1,5 +1,6 @@
 __all__ = ['MIN_ITERCOUNT', 'MIN_SALTENTROPY', 'MAX_USERNAMELEN',
-           'MAX_BLOBLEN', 'MAX_NEWADDRESS']
+           'MAX_BLOBLEN', 'MAX_NEWADDRESS', 'MAX_BULKADDRESS',
+           'MAX_BATCHOPS']
 
 MAX_USERNAMELEN = 20
 MAX_BLOBLEN = 8192      # A blob may not contain more than 8k bytes.
@@ -10,3 +11,9 @@ MIN_SALTENTROPY = 0.95  # Range: [0, 1]
 
 # Maximum number of addresses that may be derived in one request.
 MAX_NEWADDRESS = 100
+# Maximum number of addresses in one streamed bulk request, sent in pages
+# of up to MAX_NEWADDRESS.
+MAX_BULKADDRESS = 10000
+
+# Maximum number of operations in a single batch request.
+MAX_BATCHOPS = 16
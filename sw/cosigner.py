@@ -0,0 +1,229 @@
+"""
+HTTP client for the cosigner servers (js/cosigner).
+"""
+import json
+import time
+import random
+import logging
+import threading
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .util import ProcessLocal
+
+__all__ = ['CosignerClient']
+
+
+class Backend(object):
+    """One cosigner server and what this worker knows about it."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.in_flight = 0
+        self.failures = 0
+        # The circuit is open, and the backend skipped, until this time.
+        self.open_until = 0
+        self.healthy = True
+
+    def stats(self):
+        return {'url': self.url, 'in_flight': self.in_flight,
+                'failures': self.failures, 'healthy': self.healthy,
+                'open': self.open_until > time.time()}
+
+
+class CosignerClient(object):
+    """
+    Keep-alive connections to one or more cosigner servers, shared by
+    every request of a worker. Calls never raise: failures are returned
+    as {'error': reason}, the same shape the cosigner itself uses.
+
+    Each call goes to the healthy backend with the fewest calls in flight.
+    A backend that fails failure_threshold calls in a row is skipped for
+    reset_timeout seconds, then gets a single trial call. Every
+    health_interval seconds, /health is checked on each backend.
+
+    With hedge_after, calls to the (idempotent) hedge_paths still running
+    after that many seconds are also sent to a second backend, and the
+    first answer wins.
+
+    At most max_in_flight requests to the cosigners run at once. Each
+    attempt holds a slot until it completes, even one that lost a hedged
+    race, and a hedge is only sent if a slot is free.
+    """
+
+    def __init__(self, url, pool_size=10, connect_timeout=2, read_timeout=30,
+                 max_in_flight=20, health_interval=5, failure_threshold=3,
+                 reset_timeout=30, hedge_after=None,
+                 hedge_paths=('/balance',)):
+        urls = [url] if isinstance(url, (str, type(u''))) else url
+        self.backends = [Backend(entry) for entry in urls]
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.health_interval = health_interval
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge_after = hedge_after
+        self.hedge_paths = hedge_paths
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._http = ProcessLocal(self._connect)
+
+    def _connect(self):
+        http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.backends),
+                              pool_maxsize=self.pool_size)
+        http.mount('http://', adapter)
+        http.mount('https://', adapter)
+        if self.health_interval:
+            self._spawn(self._check_health, http)
+        return http
+
+    def _session(self):
+        return self._http.get()
+
+    def _spawn(self, func, *args):
+        thread = threading.Thread(target=func, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _check_health(self, http):
+        while True:
+            time.sleep(self.health_interval)
+            for backend in self.backends:
+                try:
+                    res = http.get(backend.url + '/health',
+                                   timeout=self.timeout[0])
+                    # Anything but a server error means the process is up.
+                    healthy = res.status_code < 500
+                except requests.RequestException:
+                    healthy = False
+                if backend.healthy != healthy:
+                    logging.warning("Cosigner {} is {}".format(
+                        backend.url, 'up' if healthy else 'down'))
+                backend.healthy = healthy
+
+    def _pick(self, exclude=()):
+        """Reserve the least loaded available backend, or return None."""
+        now = time.time()
+        with self._lock:
+            candidates = [backend for backend in self.backends
+                          if backend not in exclude and backend.healthy
+                          and backend.open_until <= now]
+            if not candidates:
+                return None
+            least = min(backend.in_flight for backend in candidates)
+            backend = random.choice([entry for entry in candidates
+                                     if entry.in_flight == least])
+            if backend.failures >= self.failure_threshold:
+                # Half open: let this call through as a trial, but keep
+                # the others away until it completes.
+                backend.open_until = now + self.reset_timeout
+            backend.in_flight += 1
+        return backend
+
+    def _attempt(self, backend, path, body):
+        """Return (ok, content), ok is False if backend did not answer."""
+        try:
+            res = self._session().post(
+                backend.url + path, data=body,
+                headers={'Content-Type': 'application/json'},
+                timeout=self.timeout)
+            ok, content = True, res.json()
+        except (requests.RequestException, ValueError):
+            logging.exception("Cosigner request to {}{} failed".format(
+                backend.url, path))
+            metrics.counter('cosigner.failed').inc()
+            ok, content = False, {'error': 'cosigner request failed'}
+
+        with self._lock:
+            backend.in_flight -= 1
+            if ok:
+                backend.failures = 0
+                backend.open_until = 0
+            else:
+                backend.failures += 1
+                if backend.failures >= self.failure_threshold:
+                    backend.open_until = time.time() + self.reset_timeout
+        return ok, content
+
+    def _hedged(self, path, body):
+        """Run a call holding a slot, which is released by its attempt."""
+        results = Queue()
+        tried = []
+
+        def start(reserved=False):
+            if not reserved and not self._slots.acquire(False):
+                return False
+            backend = self._pick(exclude=tried)
+            if backend is None:
+                self._slots.release()
+                return False
+            tried.append(backend)
+
+            def attempt():
+                try:
+                    results.put(self._attempt(backend, path, body))
+                finally:
+                    self._slots.release()
+            self._spawn(attempt)
+            return True
+
+        if not start(reserved=True):
+            return {'error': 'no cosigner available'}
+        pending = 1
+        hedged = False
+        content = None
+        while pending:
+            try:
+                ok, content = results.get(
+                    timeout=None if hedged else self.hedge_after)
+            except Empty:
+                # The first backend is slow, ask another one as well.
+                hedged = True
+                if start():
+                    metrics.counter('cosigner.hedged').inc()
+                    pending += 1
+                continue
+            pending -= 1
+            if ok:
+                return content
+            if not hedged:
+                # It failed quickly, the call is safe to repeat elsewhere.
+                hedged = True
+                if start():
+                    pending += 1
+        return content
+
+    def call(self, path, **kwargs):
+        if not self._slots.acquire(False):
+            logging.error("Too many cosigner requests in flight")
+            metrics.counter('cosigner.rejected').inc()
+            return {'error': 'cosigner is busy'}
+
+        body = json.dumps(kwargs)
+        with metrics.timed('cosigner' + path.replace('/', '.')):
+            if self.hedge_after and path in self.hedge_paths:
+                content = self._hedged(path, body)
+            else:
+                try:
+                    backend = self._pick()
+                    if backend is None:
+                        content = {'error': 'no cosigner available'}
+                    else:
+                        content = self._attempt(backend, path, body)[1]
+                finally:
+                    self._slots.release()
+
+        if content is None:
+            # The cosigner fails without a reason in some cases.
+            return {'error': 'cosigner returned no result'}
+        return content
+
+    def stats(self):
+        return [backend.stats() for backend in self.backends]
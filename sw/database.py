@@ -1,9 +1,28 @@
+import time
+import zlib
 import enum
+import random
+from contextlib import contextmanager
 from sqlalchemy import (Column, Integer, String, Enum, BigInteger, DateTime,
-                        LargeBinary, ForeignKey, func, create_engine)
-from sqlalchemy.orm import relationship, sessionmaker, scoped_session
+                        LargeBinary, ForeignKey, Index, event, func,
+                        create_engine)
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.orm import (relationship, sessionmaker, scoped_session,
+                            deferred, undefer, Session)
+from sqlalchemy.sql.expression import Select
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.exc import IntegrityError
+try:
+    import zstd
+except ImportError:
+    zstd = None
+try:
+    from greenlet import getcurrent
+except ImportError:
+    getcurrent = None
+
+from . import metrics
 
 
 KeyType = enum.Enum('KeyType', 'publickey tfa readonly')
@@ -11,6 +30,49 @@ KeyType = enum.Enum('KeyType', 'publickey tfa readonly')
 Base = declarative_base()
 
 
+class CompressedBinary(TypeDecorator):
+    """
+    LargeBinary compressed on write, with zstd when available and zlib
+    otherwise. Stored values start with a byte telling how they were
+    written; values stored before this type was used have no such byte
+    (they are ASCII text) and are returned unchanged.
+    """
+    impl = LargeBinary
+
+    RAW = b'\x00'
+    ZLIB = b'\x01'
+    ZSTD = b'\x02'
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, bytes):
+            value = value.encode('utf8')
+        if zstd is not None:
+            packed = self.ZSTD + zstd.compress(value)
+        else:
+            packed = self.ZLIB + zlib.compress(value, 6)
+        if len(packed) > len(value):
+            packed = self.RAW + value
+        return packed
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        value = bytes(value)
+        marker = value[:1]
+        if marker == self.RAW:
+            return value[1:]
+        elif marker == self.ZLIB:
+            return zlib.decompress(value[1:])
+        elif marker == self.ZSTD:
+            if zstd is None:
+                raise Exception("Value compressed with zstd, but the zstd "
+                                "module is not installed")
+            return zstd.decompress(value[1:])
+        return value
+
+
 class User(Base):
     __tablename__ = 'user'
 
@@ -21,6 +83,13 @@ class User(Base):
     user_check = Column(String(6), nullable=False)
     itercount = Column(Integer, nullable=False)
     deactivated_at = Column(DateTime)
+    # Number of WalletBlob rows, kept in step by UserStoreBlob.post.
+    blob_count = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        # Covers the lookup done by /user/data.
+        Index('ix_user_username_check', username, user_check),
+    )
 
 
 class UserKey(Base):
@@ -41,10 +110,21 @@ class WalletBlob(Base):
     __tablename__ = 'wallet_blob'
 
     id = Column(String(36), primary_key=True)
-    user_id = Column(String, ForeignKey(User.id), nullable=False)
+    user_id = Column(Integer, ForeignKey(User.id), nullable=False)
     created_at = Column(DateTime, default=func.now(), nullable=False)
-    blob = Column(LargeBinary)
+    # Deferred: queries that need it must ask for it (see undefer).
+    blob = deferred(Column(CompressedBinary))
+    # Size of blob, so it can be compared without reading the blob.
+    blob_length = Column(Integer)
     updates_left = Column(Integer)
+    # Incremented on every change to blob, digest is its SHA-1 in hex.
+    version = Column(Integer, default=1, nullable=False)
+    digest = Column(String(40))
+
+    __table_args__ = (
+        # Covers the (id, version) listing behind /user and /user/changes.
+        Index('ix_wallet_blob_user', user_id, id, version),
+    )
 
 
 class CosignerWallet(Base):
@@ -52,20 +132,135 @@ class CosignerWallet(Base):
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey(User.id), nullable=False)
-    wallet = Column(LargeBinary, nullable=False)
+    wallet = deferred(Column(CompressedBinary, nullable=False))
     # Limit server-managed cosigners to 1 (at max) per wallet.
     wallet_id = Column(String(36), ForeignKey(WalletBlob.id), nullable=False,
                        unique=True)
 
+    __table_args__ = (
+        # The lookup done by /address and /balance.
+        Index('ix_cosigner_wallet_user', user_id, wallet_id),
+    )
+
+
+class CosignerAddress(Base):
+    """Address derived by a server-controlled cosigner."""
+    __tablename__ = 'cosigner_address'
+
+    id = Column(Integer, primary_key=True)
+    cosigner_id = Column(Integer, ForeignKey(CosignerWallet.id),
+                         nullable=False)
+    address = Column(String, unique=True, nullable=False)
+    path = Column(String, nullable=False)
+    # Last component of path, used to hand out addresses in order.
+    path_index = Column(Integer, nullable=False)
+    created_on = Column(BigInteger)
+    # Addresses derived ahead of time have no issued_at until a client
+    # receives them. claim identifies the request that took them.
+    issued_at = Column(DateTime)
+    claim = Column(String(36), index=True)
+
+    __table_args__ = (
+        Index('ix_cosigner_address_unused', cosigner_id, issued_at,
+              path_index),
+    )
+
+
+class RoutingSession(Session):
+    """
+    Session bound to the primary engine that sends plain SELECTs to one
+    of the replicas while info['replica'] is set (see use_replica).
+    Flushes, UPDATEs and everything else always go to the primary.
+    """
 
-def setup_engine(**cfg):
+    def __init__(self, replicas=(), **kwargs):
+        super(RoutingSession, self).__init__(**kwargs)
+        self.replicas = replicas
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.info.get('replica') and isinstance(clause, Select):
+            return random.choice(self.replicas)
+        return super(RoutingSession, self).get_bind(mapper, clause, **kwargs)
+
+
+class ShardSession(Session):
+    """
+    Session whose statements all go to the shard set in info['shard']
+    (see Application.use_shard), one of the engines in shards.
+    """
+
+    def __init__(self, shards=(), **kwargs):
+        super(ShardSession, self).__init__(**kwargs)
+        self.shards = shards
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        shard = self.info.get('shard')
+        if shard is None:
+            raise Exception("No shard selected for this session")
+        return self.shards[shard]
+
+
+def bulk_changes(context):
+    """
+    Names of the columns set by the bulk Query.update() behind context,
+    as given to the after_bulk_update session event, or None for a bulk
+    delete. These skip the mapper events, like after_update.
+    """
+    values = getattr(context, 'values', None)
+    if values is None:
+        return None
+    return set(getattr(column, 'key', column) for column in values)
+
+
+@contextmanager
+def use_replica(session, enabled=True):
+    """Route the reads made by session in the with block to a replica."""
+    previous = session.info.get('replica', False)
+    session.info['replica'] = enabled
+    try:
+        yield session
+    finally:
+        session.info['replica'] = previous
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long each checkout waits for a connection."""
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            metrics.histogram('db.pool_wait').observe(time.time() - start)
+
+
+def setup_engine(pool=None, **cfg):
+    """
+    Create an engine from cfg, the arguments to create_engine. pool, if
+    given, sizes its connection pool: size, max_overflow, timeout,
+    recycle and pre_ping.
+    """
+    if pool:
+        cfg.update(poolclass=TimedQueuePool,
+                   pool_size=pool.get('size', 5),
+                   max_overflow=pool.get('max_overflow', 10),
+                   pool_timeout=pool.get('timeout', 30),
+                   pool_recycle=pool.get('recycle', -1),
+                   pool_pre_ping=pool.get('pre_ping', False))
     return create_engine(**cfg)
 
-def session_factory(engine, **cfg):
+def session_factory(engine, replicas=(), shards=(), **cfg):
+    if shards:
+        return sessionmaker(class_=ShardSession, shards=shards, **cfg)
+    if replicas:
+        return sessionmaker(bind=engine, class_=RoutingSession,
+                            replicas=replicas, **cfg)
     return sessionmaker(bind=engine, **cfg)
 
 def get_session(session_factory):
-    return scoped_session(session_factory)
+    # Under gevent each request runs in its own greenlet, possibly many in
+    # a single thread, so scope sessions to the greenlet.
+    return scoped_session(session_factory, scopefunc=getcurrent)
 
 
 if __name__ == "__main__":
@@ -76,7 +271,23 @@ if __name__ == "__main__":
     if not configpath:
         raise Exception("DEGLET_CONFIG not specified in the environment")
     mod = json.load(open(configpath))
-    engine = setup_engine(**mod['api_database']['engine'])
+    dbcfg = mod['api_database']
+    engine = setup_engine(**dbcfg['engine'])
+
+    def create(engine):
+        # A new database already has the latest schema, an existing one
+        # must be brought up to date with sw.migrate instead.
+        fresh = not engine.has_table(User.__tablename__)
+        Base.metadata.create_all(engine)
+        if fresh:
+            from .migrate import stamp
+            stamp(engine)
 
-    Base.metadata.bind = engine
-    Base.metadata.create_all()
+    if dbcfg.get('shards'):
+        # The main database only holds the shard directory.
+        from .shard import DirectoryBase
+        DirectoryBase.metadata.create_all(engine)
+        for cfg in dbcfg['shards']:
+            create(setup_engine(**cfg))
+    else:
+        create(engine)
@@ -0,0 +1,256 @@
+"""
+Export the API database to a compact file and import it elsewhere.
+
+    DEGLET_CONFIG=config/default.json python -m sw.dump export FILE
+    DEGLET_CONFIG=config/default.json python -m sw.dump import FILE
+
+With api_database.shards, the commands above copy the shard directory
+of the main database, and each shard is copied on its own with
+--shard N. Restoring a sharded deployment takes all of them.
+
+The file is a sequence of chunks, each a 4 byte big-endian length
+followed by a zlib-compressed JSON object. The first chunk describes the
+dump; every other one holds up to --chunk rows of a table, in primary
+key order, with the last key it contains. Running export again on an
+unfinished file resumes after its last complete chunk; running import
+again skips the chunks already present in the target database.
+Payloads are copied as stored, without being decompressed.
+
+A single export run reads every table from one snapshot, so the rows of
+one table only refer to rows exported from the others. A resumed export
+takes a new snapshot: only each table is consistent then, and rows
+written in between may refer to rows the file lacks.
+"""
+import os
+import json
+import zlib
+import base64
+import struct
+import argparse
+import datetime
+
+from sqlalchemy import (select, DateTime, Integer, LargeBinary, type_coerce,
+                        column)
+from sqlalchemy.sql import table as raw_table
+from sqlalchemy.orm import sessionmaker
+
+from . import database as db
+from .shard import UserShard, KeyShard
+from .migrate import current_version
+
+__all__ = ['export', 'restore', 'TABLES', 'DIRECTORY_TABLES']
+
+FORMAT = 'deglet-dump'
+
+# In the order they can be inserted back.
+TABLES = [db.User.__table__, db.UserKey.__table__, db.WalletBlob.__table__,
+          db.CosignerWallet.__table__, db.CosignerAddress.__table__]
+# The shard directory, in the main database when sharded.
+DIRECTORY_TABLES = [UserShard.__table__, KeyShard.__table__]
+
+LENGTH = struct.Struct('>I')
+TIMESTAMP = '%Y-%m-%dT%H:%M:%S'
+
+
+def _key(table):
+    """The primary key column of table, chunks are in its order."""
+    return list(table.primary_key.columns)[0]
+
+
+def _binary(col):
+    return isinstance(col.type, (LargeBinary, db.CompressedBinary))
+
+
+def _encode(col, value):
+    if value is None:
+        return None
+    if _binary(col):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    if isinstance(col.type, DateTime):
+        return value.isoformat()
+    return value
+
+
+def _decode(col, value):
+    if value is None:
+        return None
+    if _binary(col):
+        return base64.b64decode(value)
+    if isinstance(col.type, DateTime):
+        fmt = TIMESTAMP + ('.%f' if '.' in value else '')
+        return datetime.datetime.strptime(value, fmt)
+    return value
+
+
+def _stored(col):
+    """col as found in the database, compressed payloads included."""
+    if _binary(col):
+        return type_coerce(col, LargeBinary).label(col.name)
+    return col
+
+
+def write_chunk(out, obj):
+    data = zlib.compress(json.dumps(obj, separators=(',', ':')).encode(
+        'utf8'))
+    out.write(LENGTH.pack(len(data)))
+    out.write(data)
+    out.flush()
+    os.fsync(out.fileno())
+
+
+def read_chunks(src):
+    """Yield (offset after the chunk, chunk) until the end or a torn one."""
+    while True:
+        head = src.read(LENGTH.size)
+        if len(head) < LENGTH.size:
+            return
+        size, = LENGTH.unpack(head)
+        data = src.read(size)
+        if len(data) < size:
+            return
+        yield src.tell(), json.loads(zlib.decompress(data).decode('utf8'))
+
+
+def export(engine, path, chunk=10000, tables=TABLES):
+    """
+    Write every row of tables to path, resuming an unfinished export
+    found there. Return the number of rows written.
+    """
+    done, last, offset = set(), {}, 0
+    if os.path.exists(path):
+        with open(path, 'rb') as src:
+            for offset, entry in read_chunks(src):
+                if entry.get('done'):
+                    done.add(entry['table'])
+                elif 'table' in entry:
+                    last[entry['table']] = entry['last']
+
+    # PostgreSQL takes a new snapshot for every statement by default,
+    # rows inserted after a table was read could show up in the next.
+    isolation = ('SERIALIZABLE' if engine.dialect.name == 'sqlite'
+                 else 'REPEATABLE READ')
+    conn = engine.connect().execution_options(isolation_level=isolation)
+    session = sessionmaker(bind=conn)()
+    written = 0
+    with open(path, 'ab') as out:
+        # Drop a chunk torn by an interrupted export.
+        out.truncate(offset)
+        if not offset:
+            write_chunk(out, {'format': FORMAT,
+                              'schema': current_version(engine),
+                              'tables': [entry.name for entry in tables]})
+        for table in tables:
+            if table.name in done:
+                continue
+            pk = _key(table)
+            cols = list(table.columns)
+            query = session.query(*[_stored(col) for col in cols]).order_by(
+                pk)
+            if table.name in last:
+                query = query.filter(pk > last[table.name])
+
+            rows = []
+            # Rows come from a server-side cursor, chunk at a time.
+            for row in query.yield_per(chunk):
+                rows.append([_encode(col, value)
+                             for col, value in zip(cols, row)])
+                if len(rows) == chunk:
+                    write_chunk(out, {'table': table.name, 'rows': rows,
+                                      'last': rows[-1][0]})
+                    written += len(rows)
+                    rows = []
+            if rows:
+                write_chunk(out, {'table': table.name, 'rows': rows,
+                                  'last': rows[-1][0]})
+                written += len(rows)
+            write_chunk(out, {'table': table.name, 'done': True})
+    session.close()
+    conn.close()
+    return written
+
+
+def restore(engine, path):
+    """
+    Insert the rows dumped in path, one transaction per chunk, skipping
+    the chunks whose rows are already in the database. Return the number
+    of rows inserted.
+    """
+    tables = dict((entry.name, entry)
+                  for entry in TABLES + DIRECTORY_TABLES)
+    inserted = 0
+    with open(path, 'rb') as src:
+        chunks = read_chunks(src)
+        _, header = next(chunks)
+        if header.get('format') != FORMAT:
+            raise Exception("{} is not a dump".format(path))
+        if header['schema'] != current_version(engine):
+            raise Exception("Dump has schema version {}, database {}".format(
+                header['schema'], current_version(engine)))
+
+        for _, entry in chunks:
+            if entry.get('done'):
+                continue
+            table = tables[entry['table']]
+            pk = _key(table)
+            # Chunks go in whole, so if its last row is there, all are.
+            if engine.execute(select([pk]).where(
+                    pk == entry['last'])).first() is not None:
+                continue
+            cols = list(table.columns)
+            # Insert the payloads as they are, without compressing again.
+            target = raw_table(table.name, *[
+                column(col.name, LargeBinary if _binary(col) else col.type)
+                for col in cols])
+            params = [dict((col.name, _decode(col, value))
+                           for col, value in zip(cols, row))
+                      for row in entry['rows']]
+            with engine.begin() as conn:
+                conn.execute(target.insert(), params)
+            inserted += len(params)
+
+    if engine.dialect.name == 'postgresql':
+        # Continue the id sequences after the imported rows.
+        for name in header['tables']:
+            table = tables[name]
+            if isinstance(_key(table).type, Integer):
+                engine.execute(
+                    "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                    "coalesce(max(id), 1)) FROM \"{0}\"".format(table.name))
+    return inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or import data.')
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('path')
+    parser.add_argument('--chunk', type=int, default=10000,
+                        help='rows per chunk when exporting')
+    parser.add_argument('--shard', type=int,
+                        help='use this entry of api_database.shards')
+    args = parser.parse_args()
+
+    configpath = os.getenv('DEGLET_CONFIG')
+    if not configpath:
+        raise Exception("DEGLET_CONFIG not specified in the environment")
+    dbcfg = json.load(open(configpath))['api_database']
+    tables = TABLES
+    if args.shard is not None:
+        if not 0 <= args.shard < len(dbcfg.get('shards') or []):
+            raise Exception("Invalid shard {}".format(args.shard))
+        engine = db.setup_engine(**dbcfg['shards'][args.shard])
+    else:
+        engine = db.setup_engine(**dbcfg['engine'])
+        if dbcfg.get('shards'):
+            # The users are on the shards, only the directory is here.
+            tables = DIRECTORY_TABLES
+
+    if args.action == 'export':
+        count = export(engine, args.path, args.chunk, tables)
+        print('Exported {} rows to {}'.format(count, args.path))
+    else:
+        count = restore(engine, args.path)
+        print('Imported {} rows from {}'.format(count, args.path))
+
+
+if __name__ == "__main__":
+    main()
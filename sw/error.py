@@ -1,7 +1,8 @@
 from collections import namedtuple
 
 from .constant import (MIN_ITERCOUNT, MAX_USERNAMELEN, MAX_BLOBLEN,
-                       MAX_NEWADDRESS)
+                       MAX_BLOBCOUNT, MAX_NEWADDRESS, MAX_BULKADDRESS,
+                       MAX_BATCHOPS)
 
 __all__ = ['ErrorCode', 'Errors', 'COSIGNER_ERR']
 
@@ -13,6 +14,7 @@ class Errors:
     UserNotFound = ErrorCode(404, 'user not found')
     WalletNotFound = ErrorCode(404, 'wallet not found')
     CosignerNotFound = ErrorCode(404, 'cosigner not found for this wallet')
+    JobNotFound = ErrorCode(404, 'job not found')
 
     GenericError = ErrorCode(700, 'request could not be processed')
     MissingArguments = ErrorCode(701, 'request is missing arguments')
@@ -24,6 +26,16 @@ class Errors:
     InvalidUsername = ErrorCode(902, 'username already in use')
     InvalidAddressCount = ErrorCode(903,
         'num must be between 1 and {}'.format(MAX_NEWADDRESS))
+    InvalidWalletCount = ErrorCode(904,
+        'ids must contain between 1 and {} wallets'.format(MAX_BLOBCOUNT))
+    InvalidBatch = ErrorCode(905,
+        'ops must contain between 1 and {} operations'.format(MAX_BATCHOPS))
+    InvalidOperation = ErrorCode(906, 'operation not available in a batch')
+    InvalidDelta = ErrorCode(907, 'delta does not apply to the stored blob')
+    InvalidBulkCount = ErrorCode(908,
+        'num must be between 1 and {}'.format(MAX_BULKADDRESS))
+    InvalidCursor = ErrorCode(909,
+        'after must be a path index, sent with the stream id')
 
     UsernameTooLong = ErrorCode(1000,
         'username is too long, keep it below {} chars'.format(MAX_USERNAMELEN))
@@ -32,7 +44,14 @@ class Errors:
     BadSalt = ErrorCode(1002, 'salt is not random enough')
     BlobTooLong = ErrorCode(1003,
         'blob is too long, keep it below {} chars'.format(MAX_BLOBLEN))
+    BlobTooShort = ErrorCode(1005,
+        'blob must be longer than the one stored')
 
     TooManyBlobs = ErrorCode(1429, 'no more blobs allowed for this account')
+    NoUpdatesLeft = ErrorCode(1403, 'no more updates allowed for this blob')
+    BlobConflict = ErrorCode(1409,
+        'blob was changed, update the latest version instead')
     CosigningDisabled = ErrorCode(1404, 'cosigning not available')
     CosignerError = ErrorCode(1500, 'cosigner could not complete request')
+    RateLimited = ErrorCode(1420, 'too many requests, slow down')
+    ServerBusy = ErrorCode(1503, 'server is busy, try again later')
@@ -0,0 +1,98 @@
+"""
+Change notifications for requests that wait for something to happen,
+such as a user's blobs being updated from another device.
+"""
+import time
+import threading
+
+from . import metrics
+from .offload import PoolBusy
+from .util import ProcessLocal
+
+__all__ = ['ChangeFeed']
+
+
+class ChangeFeed(object):
+    """
+    Each topic has a sequence number kept in store (see sw.store) that
+    publish moves forward. Requests waiting on a topic in this worker are
+    woken right away; those in other workers sharing a SQLiteStore are
+    woken by a single thread per worker that checks every topic waited on
+    each poll_interval seconds.
+
+    Waits last at most max_wait seconds. At most max_waiters requests of
+    a worker may wait at once, further ones are refused with PoolBusy so
+    they do not take every connection slot of the worker.
+    """
+
+    def __init__(self, store, poll_interval=1, max_wait=30, max_waiters=50,
+                 ttl=86400):
+        self.store = store
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.max_waiters = max_waiters
+        self.ttl = ttl
+        # topic -> list of (seq, threading.Event)
+        self._waiters = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._poller = ProcessLocal(self._start)
+
+    def current(self, topic):
+        return self.store.get('feed:' + topic) or 0
+
+    def publish(self, topic):
+        def advance(seq):
+            seq = (seq or 0) + 1
+            return seq, seq
+        self.store.update('feed:' + topic, advance, self.ttl)
+        self._wake(topic, lambda seq: True)
+
+    def wait(self, topic, seq, timeout):
+        """
+        Wait up to timeout seconds for topic to move past seq, the value
+        current returned earlier. Return True if it did.
+        """
+        timeout = min(timeout, self.max_wait)
+        event = threading.Event()
+        with self._lock:
+            if self._count >= self.max_waiters:
+                metrics.counter('feed.rejected').inc()
+                raise PoolBusy()
+            self._count += 1
+            self._waiters.setdefault(topic, []).append((seq, event))
+        self._poller.get()
+
+        try:
+            # It may have moved before this waiter was registered.
+            if self.current(topic) != seq:
+                return True
+            return event.wait(timeout)
+        finally:
+            with self._lock:
+                self._count -= 1
+                waiters = self._waiters[topic]
+                waiters.remove((seq, event))
+                if not waiters:
+                    del self._waiters[topic]
+
+    def _wake(self, topic, moved):
+        with self._lock:
+            for seq, event in self._waiters.get(topic, ()):
+                if moved(seq):
+                    event.set()
+
+    def _start(self):
+        thread = threading.Thread(target=self._poll)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                topics = list(self._waiters)
+            for topic in topics:
+                current = self.current(topic)
+                self._wake(topic, lambda seq: seq != current)
@@ -0,0 +1,93 @@
+"""
+Runs several API operations from a single signed request.
+"""
+import logging
+
+from flask import Blueprint, request, current_app, g
+from flask.ext.restful import Api, Resource
+from flask.ext.login import login_required
+from werkzeug.exceptions import HTTPException
+
+from . import user, serverwallet
+from ..error import Errors
+from ..constant import MAX_BATCHOPS
+
+# Only resources that require a logged in user and read their
+# parameters from g.payload can run as part of a batch.
+BATCHABLE = (user.User, user.UserStoreBlob, serverwallet.CosignerCreate,
+             serverwallet.Address, serverwallet.Balance,
+             serverwallet.BalanceBatch)
+
+
+def dispatch(adapter, op):
+    """Run a single operation, return a Response holding its payload."""
+    method = op.get('method', 'post').upper()
+    try:
+        endpoint, args = adapter.match(op.get('path'), method)
+    except HTTPException:
+        return current_app.encode_error(Errors.InvalidOperation)
+    resource = getattr(current_app.view_functions[endpoint], 'view_class',
+                       None)
+    if resource not in BATCHABLE:
+        return current_app.encode_error(Errors.InvalidOperation)
+    # Each operation counts as a call to its own path, the IP and key
+    # limits were charged once for the whole batch.
+    limited = current_app.throttle(op.get('path'), batched=True)
+    if limited is not None:
+        return limited
+
+    g.payload = op.get('data') or {}
+    try:
+        return getattr(resource(), method.lower())(**args)
+    except Exception:
+        logging.exception("Batched operation {} {} failed".format(
+            method, op.get('path')))
+        current_app.session.rollback()
+        return current_app.encode_error(Errors.GenericError)
+
+
+class Batch(Resource):
+
+    @login_required
+    def post(self):
+        """
+        Run a list of operations in order, as if each had been sent on
+        its own, but with a single signature check, nonce and signed
+        response.
+
+        Parameters required from the client:
+            * ops [list] - operations, each one with:
+                * path [text]   - e.g. "/balance"
+                * method [text] - HTTP method (default: "post")
+                * data [object] - parameters for that operation
+
+        Returns:
+            * result [list] - {status, data} per operation, in order
+        """
+        ops = g.payload.get('ops')
+        if not isinstance(ops, list) or not 0 < len(ops) <= MAX_BATCHOPS:
+            return current_app.encode_error(Errors.InvalidBatch)
+
+        adapter = current_app.create_url_adapter(request)
+        payload = g.payload
+        result = []
+        g.unsigned = True
+        try:
+            for op in ops:
+                if not isinstance(op, dict):
+                    resp = current_app.encode_error(Errors.InvalidOperation)
+                else:
+                    resp = dispatch(adapter, op)
+                result.append({'status': resp.status_code,
+                               'data': resp.payload})
+        finally:
+            g.unsigned = False
+            g.payload = payload
+
+        return current_app.encode_success({'result': result})
+
+
+blueprint = Blueprint('batch', __name__)
+
+api = Api(blueprint)
+api.add_resource(Batch, '/batch')
@@ -1,6 +1,7 @@
 """
 Handles server-side cosigner creation and utilities related to it.
 """
+import uuid
 import logging
 
 from flask import Blueprint, current_app, g
@@ -8,24 +9,73 @@ from flask.ext.restful import Api, Resource
 from flask.ext.login import login_required, current_user
 
 from .. import database as db
+from ..util import concurrent_map
+from ..offload import PoolBusy
 from ..error import Errors, ErrorCode, COSIGNER_ERR
-from ..constant import MAX_NEWADDRESS
+from ..addrpool import path_index
+from ..constant import MAX_NEWADDRESS, MAX_BULKADDRESS, MAX_BLOBCOUNT
 
 
-def insert(record):
+def join_cosigner(shard, user_id, wallet_id, join_secret):
+    """
+    Have the cosigner join wallet_id and store it for user_id. Return
+    {walletId} on success, or an ErrorCode.
+    """
+    current_app.use_shard(shard)
+    # Send the join request to the cosigning server.
+    resp = current_app.cosigner(
+        '/join', secret=join_secret, walletId=wallet_id)
+    if resp is None:
+        # Cosigner server is not available.
+        return Errors.CosigningDisabled
+    if 'wallet' not in resp:
+        logging.info(resp)
+        return ErrorCode(COSIGNER_ERR, resp['error'])
+
+    # Store the cosigner wallet.
+    cowallet = db.CosignerWallet(
+        wallet_id=wallet_id,
+        user_id=user_id,
+        wallet=resp['wallet'])
     session = current_app.session
-    session.add(record)
+    session.add(cowallet)
     try:
         session.commit()
-        return current_app.encode_success()
     except Exception:
         logging.exception("Failed to commit cowallet record")
         session.rollback()
-        resp = current_app.encode_error(Errors.GenericError)
-        return resp
+        return Errors.GenericError
     finally:
         session.close()
 
+    current_app.note_write(user_id)
+    if current_app.address_pool is not None:
+        # Derive the first addresses before the client asks.
+        current_app.address_pool.refill_async(wallet_id, shard)
+    return {'walletId': wallet_id}
+
+
+def wallet_balance(wallet_id, credentials):
+    """
+    Return the cosigner's answer to /balance for a wallet, going through
+    the balance cache when one is configured.
+    """
+    cosigner = current_app.cosigner
+
+    def fetch():
+        return cosigner('/balance', wallet=credentials)
+
+    cache = current_app.balance_cache
+    if cache is None:
+        return fetch()
+    return cache.get(wallet_id, fetch,
+                     keep=lambda resp: resp is not None and 'balance' in resp)
+
+
+def job_owner():
+    """Who a join job belongs to, user ids are only unique per shard."""
+    return '{}:{}'.format(current_app.current_shard(), current_user.id)
+
 
 class CosignerCreate(Resource):
 
@@ -50,25 +100,55 @@ class CosignerCreate(Resource):
         if not count:
             return current_app.encode_error(Errors.WalletNotFound)
 
-        # Send the join request to the cosigning server.
-        resp = current_app.cosigner(
-            '/join', secret=join_secret, walletId=wallet_id)
-        if resp is None:
-            # Cosigner server is not available.
-            return current_app.encode_error(Errors.CosigningDisabled)
-        if 'wallet' not in resp:
-            logging.info(resp)
-            err = ErrorCode(COSIGNER_ERR, resp['error'])
-            return current_app.encode_error(err)
-
-        # Store the cosigner wallet.
-        cowallet = db.CosignerWallet(
-            wallet_id=wallet_id,
-            user_id=current_user.id,
-            wallet=resp['wallet'])
-        result = insert(cowallet)
+        shard = current_app.current_shard()
+        jobs = current_app.join_jobs
+        if jobs is None:
+            result = join_cosigner(shard, current_user.id, wallet_id,
+                                   join_secret)
+            if isinstance(result, ErrorCode):
+                return current_app.encode_error(result)
+            return current_app.encode_success()
 
-        return result
+        # Joining can take seconds, do it in the background and let the
+        # client poll /cosigner/job.
+        try:
+            job_id = jobs.submit(job_owner(), join_cosigner, shard,
+                                 current_user.id, wallet_id, join_secret)
+        except PoolBusy:
+            logging.error("Too many cosigner joins waiting")
+            return current_app.encode_error(Errors.ServerBusy, 503)
+        return current_app.encode_success({'job': job_id})
+
+
+class CosignerJob(Resource):
+
+    @login_required
+    def post(self):
+        """
+        Report the state of a cosigner join started with /cosigner.
+
+        Parameters required from the client:
+            * job [text] - job ID
+
+        Returns:
+            * status [text] - pending, done or failed
+            * walletId [text] - when done
+            * error, code - when failed
+        """
+        job_id = g.payload.get('job', '').encode('ascii')
+        jobs = current_app.join_jobs
+        job = None
+        if jobs is not None and job_id:
+            job = jobs.status(job_id, job_owner())
+        if job is None:
+            return current_app.encode_error(Errors.JobNotFound)
+
+        data = {'status': job['status']}
+        if job['status'] == 'done':
+            data.update(job['result'])
+        elif job['status'] == 'failed':
+            data.update(error=job['error'], code=job['code'])
+        return current_app.encode_success(data)
 
 
 class Address(Resource):
@@ -94,36 +174,189 @@ class Address(Resource):
             return current_app.encode_error(Errors.InvalidAddressCount)
 
         # Get the cosigner for this wallet for this user.
-        record = current_app.session.query(db.CosignerWallet).filter(
-            db.CosignerWallet.user_id == current_user.id,
-            db.CosignerWallet.wallet_id == wallet_id).one_or_none()
+        with current_app.replica(current_user.id):
+            record = current_app.session.query(db.CosignerWallet).filter(
+                db.CosignerWallet.user_id == current_user.id,
+                db.CosignerWallet.wallet_id == wallet_id).options(
+                    db.undefer(db.CosignerWallet.wallet)).one_or_none()
         if record is None:
             return current_app.encode_error(Errors.CosignerNotFound)
+        # Keep it, the pool commits and so expires record.
+        wallet = record.wallet
 
-        # Send the request to the cosigning server.
-        resp = current_app.cosigner(
-            '/address/new', num=num, wallet=record.wallet)
+        # Hand out addresses derived ahead of time first, then ask the
+        # cosigning server for whatever is missing.
+        entries = []
+        if current_app.address_pool is not None:
+            entries = current_app.address_pool.take(record, num)
 
-        if 'address' in resp:
+        if len(entries) < num:
+            resp = current_app.cosigner(
+                '/address/new', num=num - len(entries), wallet=wallet)
+            if resp is None:
+                return current_app.encode_error(Errors.CosigningDisabled)
+            if 'address' not in resp:
+                logging.error(resp)
+                return current_app.encode_error(Errors.CosignerError)
+
+            derived = resp['address']
+            if isinstance(derived, dict):
+                derived = [derived]
             keys = ['address', 'path', 'createdOn']
-            if isinstance(resp['address'], dict):
-                # Single address derived.
-                keys.append('walletId')
-                data = {key: resp['address'][key] for key in keys}
-            else:
-                # Multiple addresses.
-                data = {
-                    'walletId': resp['address'][0]['walletId'],
-                    'result': None
-                }
-                data['result'] = [{key: entry[key] for key in keys}
-                        for entry in resp['address']]
-            result = current_app.encode_success(data)
+            entries.extend({key: entry[key] for key in keys}
+                           for entry in derived)
+
+        if num == 1:
+            # Single address derived.
+            data = dict(entries[0], walletId=wallet_id)
         else:
-            logging.error(resp)
-            result = current_app.encode_error(Errors.CosignerError)
+            # Multiple addresses.
+            data = {'walletId': wallet_id, 'result': entries}
+        return current_app.encode_success(data)
 
-        return result
+
+class AddressBulk(Resource):
+
+    @login_required
+    def post(self):
+        """
+        Stream many addresses, one signed page per line. Pages hold up
+        to 100 addresses and are sent as soon as they are derived.
+
+        Parameters required from the client:
+            * id [text]      - wallet ID
+            * num [number]   - number of addresses to obtain (max: 10000)
+
+        Optional parameters, to resume an interrupted stream:
+            * stream [text]  - stream id from the pages already received
+            * after [number] - path index of the last address already
+                               received (default: replay from the start)
+            * page [number]  - addresses per page (max: 100)
+
+        Returns, in each page:
+            * walletId [text]
+            * stream [text]     - id of this stream
+            * result [list]     - {address, path, createdOn}
+            * cursor [number]   - path index of the last address in result,
+                                  to be passed as after when resuming
+            * remaining [number]
+        A page with error and code ends the stream early.
+        """
+        wallet_id = g.payload.get('id', '').encode('ascii')
+        if not wallet_id:
+            return current_app.encode_error(Errors.MissingArguments)
+        num = int(g.payload.get('num', 0))
+        if num <= 0 or num > MAX_BULKADDRESS:
+            return current_app.encode_error(Errors.InvalidBulkCount)
+        page = min(max(int(g.payload.get('page', MAX_NEWADDRESS)), 1),
+                   MAX_NEWADDRESS)
+        stream = g.payload.get('stream')
+        after = g.payload.get('after', -1)
+        if stream is None:
+            if 'after' in g.payload:
+                return current_app.encode_error(Errors.InvalidCursor)
+            stream = str(uuid.uuid4())
+        elif not isinstance(stream, basestring) or len(stream) != 36:
+            return current_app.encode_error(Errors.InvalidCursor)
+        if not isinstance(after, int) or after < -1:
+            return current_app.encode_error(Errors.InvalidCursor)
+
+        session = current_app.session
+        record = session.query(db.CosignerWallet).filter(
+            db.CosignerWallet.user_id == current_user.id,
+            db.CosignerWallet.wallet_id == wallet_id).options(
+                db.undefer(db.CosignerWallet.wallet)).one_or_none()
+        if record is None:
+            return current_app.encode_error(Errors.CosignerNotFound)
+
+        pages = bulk_addresses(record.id, record.wallet, wallet_id, num,
+                               page, stream, after,
+                               current_app.current_shard())
+        return current_app.encode_stream(pages)
+
+
+def bulk_addresses(cosigner_id, credentials, wallet_id, num, page, stream,
+                   after, shard):
+    """
+    Produce the pages of AddressBulk. Every address handed out is
+    claimed by stream in cosigner_address, so a resumed stream replays
+    its own addresses past after and nothing issued to another request.
+    Past those, unissued addresses derived ahead by the pool are claimed
+    the way AddressPool.take does, and the others are derived page by
+    page. At most one page is held in memory.
+    """
+    session = current_app.session
+    remaining = num
+    while remaining:
+        want = min(page, remaining)
+        claimed = session.query(db.CosignerAddress).filter(
+            db.CosignerAddress.cosigner_id == cosigner_id,
+            db.CosignerAddress.claim == stream,
+            db.CosignerAddress.path_index > after).order_by(
+                db.CosignerAddress.path_index)
+        rows = claimed.limit(want).all()
+        if len(rows) < want:
+            # Only take pool addresses past the cursor, so the pages of a
+            # stream stay in path order and a resume finds them again.
+            unused = [row.id for row in session.query(
+                db.CosignerAddress.id).filter(
+                    db.CosignerAddress.cosigner_id == cosigner_id,
+                    db.CosignerAddress.issued_at == None,
+                    db.CosignerAddress.path_index > after).order_by(
+                        db.CosignerAddress.path_index).limit(
+                            want - len(rows))]
+            if unused:
+                session.query(db.CosignerAddress).filter(
+                    db.CosignerAddress.id.in_(unused),
+                    db.CosignerAddress.issued_at == None).update(
+                        {'issued_at': db.func.now(), 'claim': stream},
+                        synchronize_session=False)
+                session.commit()
+                rows = claimed.limit(want).all()
+        entries = [(row.address, row.path, row.path_index, row.created_on)
+                   for row in rows]
+        # Do not hold a connection while the cosigner works.
+        session.close()
+
+        if len(entries) < want:
+            resp = current_app.cosigner('/address/new',
+                                        num=want - len(entries),
+                                        wallet=credentials)
+            if resp is None or 'address' not in resp:
+                logging.error(resp)
+                err = (Errors.CosigningDisabled if resp is None
+                       else Errors.CosignerError)
+                yield {'error': err.reason, 'code': err.code}
+                return
+            derived = resp['address']
+            if isinstance(derived, dict):
+                derived = [derived]
+            for entry in derived:
+                index = path_index(entry['path'])
+                session.add(db.CosignerAddress(
+                    cosigner_id=cosigner_id, address=entry['address'],
+                    path=entry['path'], path_index=index,
+                    created_on=entry.get('createdOn'),
+                    issued_at=db.func.now(), claim=stream))
+                entries.append((entry['address'], entry['path'], index,
+                                entry.get('createdOn')))
+            session.commit()
+            session.close()
+
+        if not entries:
+            err = Errors.CosignerError
+            yield {'error': err.reason, 'code': err.code}
+            return
+        remaining -= len(entries)
+        after = entries[-1][2]
+        yield {'walletId': wallet_id, 'stream': stream, 'cursor': after,
+               'remaining': remaining,
+               'result': [{'address': address, 'path': path,
+                           'createdOn': created_on}
+                          for address, path, _, created_on in entries]}
+
+    if current_app.address_pool is not None:
+        current_app.address_pool.refill_async(wallet_id, shard)
 
 
 class Balance(Resource):
@@ -142,16 +375,20 @@ class Balance(Resource):
             return current_app.encode_error(Errors.MissingArguments)
 
         # Get the cosigner for this wallet for this user.
-        record = current_app.session.query(db.CosignerWallet).filter(
-            db.CosignerWallet.user_id == current_user.id,
-            db.CosignerWallet.wallet_id == wallet_id).one_or_none()
+        with current_app.replica(current_user.id):
+            record = current_app.session.query(db.CosignerWallet).filter(
+                db.CosignerWallet.user_id == current_user.id,
+                db.CosignerWallet.wallet_id == wallet_id).options(
+                    db.undefer(db.CosignerWallet.wallet)).one_or_none()
         if record is None:
             return current_app.encode_error(Errors.CosignerNotFound)
 
-        # Send the request to the cosigning server.
-        logging.info('still here')
-        resp = current_app.cosigner('/balance', wallet=record.wallet)
-        logging.info('result %s', resp)
+        # Send the request to the cosigning server, unless the balance
+        # for this wallet was obtained recently.
+        resp = wallet_balance(wallet_id, record.wallet)
+        if resp is None:
+            return current_app.encode_error(Errors.CosigningDisabled)
+
         if 'balance' in resp:
             data = {'btc': resp['balance']}
             result = current_app.encode_success(data)
@@ -162,9 +399,69 @@ class Balance(Resource):
         return result
 
 
+class BalanceBatch(Resource):
+
+    @login_required
+    def post(self):
+        """
+        Return the balance for several wallets at once. Wallets without a
+        server-controlled cosigner are reported with an error.
+
+        Parameters required from the client, one of:
+            * ids [list of text] - wallet IDs
+            * all [boolean]      - every wallet with a server cosigner
+
+        Returns:
+            * result [list] - {id, btc} or {id, error, code} per wallet,
+                              in the order requested
+        """
+        query = current_app.session.query(
+            db.CosignerWallet.wallet_id, db.CosignerWallet.wallet).filter(
+                db.CosignerWallet.user_id == current_user.id)
+        if g.payload.get('all'):
+            wallet_ids = None
+        else:
+            wallet_ids = [wallet_id.encode('ascii')
+                          for wallet_id in g.payload.get('ids') or []]
+            if not wallet_ids or len(wallet_ids) > MAX_BLOBCOUNT:
+                return current_app.encode_error(Errors.InvalidWalletCount)
+            query = query.filter(db.CosignerWallet.wallet_id.in_(wallet_ids))
+        with current_app.replica(current_user.id):
+            records = query.all()
+        if wallet_ids is None:
+            wallet_ids = [wallet_id for wallet_id, _ in records]
+        credentials = dict(records)
+        # Nothing else is read from the database, release the connection
+        # while waiting for the cosigner.
+        current_app.session.close()
+
+        app = current_app._get_current_object()
+
+        def fetch(wallet_id):
+            err = Errors.CosignerNotFound
+            if wallet_id in credentials:
+                with app.app_context():
+                    resp = wallet_balance(wallet_id, credentials[wallet_id])
+                if resp is None:
+                    err = Errors.CosigningDisabled
+                elif 'balance' in resp:
+                    return {'id': wallet_id, 'btc': resp['balance']}
+                else:
+                    logging.error(resp)
+                    err = Errors.CosignerError
+            return {'id': wallet_id, 'error': err.reason, 'code': err.code}
+
+        result = concurrent_map(fetch, wallet_ids,
+                                current_app.config.get('balance_fanout', 4))
+        return current_app.encode_success({'result': result})
+
+
 blueprint = Blueprint('cosigner', __name__)
 
 api = Api(blueprint)
 api.add_resource(CosignerCreate, '/cosigner')
+api.add_resource(CosignerJob, '/cosigner/job')
 api.add_resource(Address, '/address')
+api.add_resource(AddressBulk, '/address/bulk')
 api.add_resource(Balance, '/balance')
+api.add_resource(BalanceBatch, '/balance/batch')
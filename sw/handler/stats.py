@@ -0,0 +1,23 @@
+"""
+Exposes the metrics collected by this worker.
+"""
+from flask import Blueprint, current_app
+from flask.ext.restful import Api, Resource
+
+from .. import metrics
+
+
+class Metrics(Resource):
+
+    def get(self):
+        """
+        Return the counters and latency histograms of the worker that
+        handled this request.
+        """
+        return current_app.encode_success(metrics.snapshot())
+
+
+blueprint = Blueprint('stats', __name__)
+
+api = Api(blueprint)
+api.add_resource(Metrics, '/metrics')
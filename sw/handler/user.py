@@ -2,15 +2,21 @@
 Handles user creation and data retrieval for existing users.
 """
 
+import time
+import hashlib
 import logging
 
-from flask import Blueprint, Response, request, current_app, g
+from flask import (Blueprint, Response, request, current_app, g,
+                   has_app_context)
 from flask.ext.restful import Api, Resource
 from flask.ext.login import login_required, current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 
 from .. import database as db
 from ..util import entropy
 from ..auth import jws_preprocessor
+from ..offload import PoolBusy
 from ..error import ErrorCode, Errors
 from ..constant import (MIN_ITERCOUNT, MIN_SALTENTROPY,
                         MAX_USERNAMELEN, MAX_BLOBLEN, MAX_BLOBCOUNT)
@@ -69,16 +75,90 @@ def signup_insert(records):
         session.close()
 
 
+def blob_digest(blob):
+    return hashlib.sha1(blob).hexdigest()
+
+
+def apply_delta(blob, delta):
+    """
+    Apply delta, a list of [start, end, text] edits sorted by position and
+    not overlapping, to blob. Each edit replaces blob[start:end] with text.
+    Return None if delta is malformed or does not fit blob.
+    """
+    parts = []
+    pos = 0
+    try:
+        for start, end, text in delta:
+            if not pos <= start <= end <= len(blob):
+                return None
+            parts.append(blob[pos:start])
+            parts.append(text.encode('ascii'))
+            pos = end
+    except (TypeError, ValueError, AttributeError, UnicodeError):
+        return None
+    parts.append(blob[pos:])
+    return b''.join(parts)
+
+
+def blobs_etag(versions):
+    """Return an ETag for a collection of (id, version) pairs."""
+    tag = ','.join('{}:{}'.format(*entry) for entry in sorted(versions))
+    return hashlib.sha1(tag).hexdigest()
+
+
 def format_blob(*blobs):
     for b in blobs:
         yield {
             'id': b.id,
             'blob': b.blob,
+            'version': b.version,
+            'digest': b.digest,
             # Convert datetime to unix timestamp.
-            'created_at': int(b.created_at.strftime('%s'))
+            'created_at': int(time.mktime(b.created_at.timetuple()))
         }
 
 
+def blob_topic():
+    """Change feed topic for the blobs of the current user."""
+    return 'blobs:{}:{}'.format(current_app.current_shard(), current_user.id)
+
+
+def blob_versions():
+    """Return (id, version) for every blob of the current user."""
+    return current_app.session.query(
+        db.WalletBlob.id, db.WalletBlob.version).filter(
+            db.WalletBlob.user_id == current_user.id).all()
+
+
+def changed_blobs(blobs, etag, known):
+    """
+    Compare the versions held by the client to the stored ones, loading
+    the blobs themselves only for those that changed.
+    """
+    versions = blobs.with_entities(
+        db.WalletBlob.id, db.WalletBlob.version).all()
+    current = blobs_etag(versions)
+    if etag == current:
+        return {'etag': current, 'modified': False}
+
+    changed = [blob_id for blob_id, version in versions
+               if known.get(blob_id) != version]
+    stored = set(blob_id for blob_id, _ in versions)
+    removed = [blob_id for blob_id in known if blob_id not in stored]
+    result = {
+        'etag': current,
+        # Without an etag, known alone tells whether anything changed.
+        'modified': etag is not None or bool(changed or removed),
+        'blobs': [],
+        'removed': removed
+    }
+    if changed:
+        result['blobs'] = list(format_blob(*blobs.filter(
+            db.WalletBlob.id.in_(changed)).options(
+                db.undefer(db.WalletBlob.blob))))
+    return result
+
+
 class UserSignup(Resource):
 
     def post(self):
@@ -102,7 +182,22 @@ class UserSignup(Resource):
             err = records
             return current_app.encode_error(err)
 
-        return signup_insert(records)
+        username = records[0].username
+        keys = [records[1].key]
+        directory = current_app.directory
+        if directory is not None:
+            # Claim the username across all shards first.
+            shard = directory.add_user(username, keys)
+            if shard is None:
+                return current_app.encode_error(Errors.InvalidUsername)
+            current_app.use_shard(shard)
+
+        result = signup_insert(records)
+        if result.status_code == 200:
+            current_app.note_write(username)
+        elif directory is not None:
+            directory.remove_user(username, keys)
+        return result
 
 
 class UserData(Resource):
@@ -124,14 +219,62 @@ class UserData(Resource):
         if not username or len(bcheck) != 6:
             return current_app.encode_error(Errors.MissingArguments)
 
-        user = current_app.session.query(db.User).filter(
-            db.User.username == username,
-            db.User.user_check == bcheck).one_or_none()
+        # Login bursts ask for the same users over and over, reuse the
+        # signed answer while it is cached.
+        key = (username, bcheck)
+        cached = current_app.userdata_cache.get(key)
+        if cached is not None and cached[0] == request.base_url:
+            return Response(cached[1], status=cached[2])
+
+        user = None
+        if current_app.locate_user(username):
+            with current_app.replica(username):
+                user = current_app.session.query(
+                    db.User.salt, db.User.itercount).filter(
+                        db.User.username == username,
+                        db.User.user_check == bcheck).one_or_none()
         if user is None:
-            return current_app.encode_error(Errors.UserNotFound)
+            resp = current_app.encode_error(Errors.UserNotFound)
+            ttl = current_app.userdata_negative_ttl
+        else:
+            result = {'salt': user.salt, 'iterations': user.itercount}
+            resp = current_app.encode_success(result)
+            ttl = None
 
-        result = {'salt': user.salt, 'iterations': user.itercount}
-        return current_app.encode_success(result)
+        current_app.userdata_cache.set(
+            key, (request.base_url, resp.get_data(), resp.status_code), ttl)
+        return resp
+
+
+# Columns the cached /user/data answers depend on.
+USERDATA_COLUMNS = {'username', 'user_check', 'salt', 'itercount'}
+
+
+def _userdata_cache():
+    return current_app.userdata_cache if has_app_context() else None
+
+
+def _user_changed(mapper, connection, target):
+    cache = _userdata_cache()
+    if cache is not None:
+        cache.discard((target.username, target.user_check))
+
+
+def _users_bulk_changed(context):
+    changed = db.bulk_changes(context)
+    cache = _userdata_cache()
+    if (context.mapper.class_ is db.User and cache is not None and
+            (changed is None or changed & USERDATA_COLUMNS)):
+        cache.clear()
+
+
+# Drop the cached /user/data answers for users created, changed or
+# removed by this process, so a fresh signup is not hidden behind a
+# cached "user not found".
+for name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(db.User, name, _user_changed)
+event.listen(Session, 'after_bulk_update', _users_bulk_changed)
+event.listen(Session, 'after_bulk_delete', _users_bulk_changed)
 
 
 class UserStoreBlob(Resource):
@@ -170,16 +313,33 @@ class UserStoreBlob(Resource):
             # Blob size is too big.
             return current_app.encode_error(Errors.BlobTooLong)
 
-        blob_count = current_app.session.query(db.WalletBlob).filter(
-            db.WalletBlob.user_id == current_user.id).count()
-        if blob_count >= MAX_BLOBCOUNT:
+        # Take a slot from the user's quota and store the blob in the
+        # same transaction. The guarded UPDATE locks the user row, so
+        # concurrent uploads cannot both take the last slot.
+        session = current_app.session
+        reserved = session.query(db.User).filter(
+            db.User.id == current_user.id,
+            db.User.blob_count < MAX_BLOBCOUNT).update(
+                {'blob_count': db.User.blob_count + 1},
+                synchronize_session=False)
+        if not reserved:
             # This user has stored too many blobs already.
+            session.rollback()
             return current_app.encode_error(Errors.TooManyBlobs)
 
         record = db.WalletBlob(id=blob_id, user_id=current_user.id,
-                               updates_left=maxchanges, blob=blob)
-        current_app.session.add(record)
-        current_app.session.commit()
+                               updates_left=maxchanges, blob=blob,
+                               version=1, digest=blob_digest(blob),
+                               blob_length=len(blob))
+        session.add(record)
+        try:
+            session.commit()
+        except db.IntegrityError:
+            logging.exception("Failed to commit blob {}".format(blob_id))
+            session.rollback()
+            return current_app.encode_error(Errors.GenericError)
+        current_app.note_write(current_user.id)
+        current_app.change_feed.publish(blob_topic())
 
         result = format_blob(record).next()
         return current_app.encode_success(result)
@@ -188,33 +348,79 @@ class UserStoreBlob(Resource):
     def put(self):
         # XXX not implemented in the client yet.
         """
-        Update an existing blob for this user.
+        Update an existing blob for this user. The new blob must be
+        longer than the one stored.
 
         Parameters required from the client:
-            * id [text]   - blob UUID
-            * blob [text] - blob to replace the one previously stored
+            * id [text]      - blob UUID
+            * base [integer] - version of the blob the update applies to
+          and one of:
+            * blob [text]    - blob to replace the one previously stored
+            * delta [list]   - [start, end, text] edits to the stored blob,
+                               see apply_delta
 
         Returns:
-            the new blob
+            * id [text]             - blob UUID
+            * version [integer]     - version of the updated blob
+            * digest [text]         - SHA-1 of the updated blob
+            * updates_left [integer]
         """
         blob = g.payload.get('blob', '').encode('ascii')
+        delta = g.payload.get('delta')
         blob_id = g.payload.get('id', '').encode('ascii')
-        if not blob or not blob_id:
+        base = g.payload.get('base')
+        if not blob_id or base is None or (not blob and delta is None):
             # No blob specified.
             return current_app.encode_error(Errors.MissingArguments)
-        elif len(blob) > MAX_BLOBLEN:
-            # Blob size is too big.
-            return current_app.encode_error(Errors.BlobTooLong)
 
-        # Update the blob that belongs to this user only if this new one
-        # is greater (in size) than the current one.
-        record = current_app.session.query(db.WalletBlob).filter(
+        session = current_app.session
+        query = session.query(db.WalletBlob).filter(
             db.WalletBlob.user_id == current_user.id,
-            db.WalletBlob.updates_left > 0,
-            db.func.char_length(db.WalletBlob.blob) < len(blob)).update({
+            db.WalletBlob.id == blob_id)
+        current = query.with_entities(
+            db.WalletBlob.version, db.WalletBlob.updates_left,
+            db.WalletBlob.blob_length).one_or_none()
+        if current is None:
+            return current_app.encode_error(Errors.WalletNotFound)
+        version, updates_left, length = current
+        if version != base:
+            return current_app.encode_error(Errors.BlobConflict)
+        elif not updates_left:
+            return current_app.encode_error(Errors.NoUpdatesLeft)
+
+        if delta is not None:
+            # Only now are the stored bytes needed.
+            blob = apply_delta(
+                query.with_entities(db.WalletBlob.blob).scalar(), delta)
+            if blob is None:
+                return current_app.encode_error(Errors.InvalidDelta)
+        if length is None:
+            # Stored before blob_length existed.
+            length = len(query.with_entities(db.WalletBlob.blob).scalar())
+        if len(blob) > MAX_BLOBLEN:
+            # Blob size is too big.
+            return current_app.encode_error(Errors.BlobTooLong)
+        elif len(blob) <= length:
+            return current_app.encode_error(Errors.BlobTooShort)
+
+        # Update the blob only if nobody else did since base was read.
+        digest = blob_digest(blob)
+        updated = query.filter(
+            db.WalletBlob.version == base,
+            db.WalletBlob.updates_left > 0).update({
                 'updates_left': db.WalletBlob.updates_left - 1,
-                'blob': blob})
-        result = format_blob(record).next()
+                'version': db.WalletBlob.version + 1,
+                'digest': digest,
+                'blob_length': len(blob),
+                'blob': blob}, synchronize_session=False)
+        session.commit()
+        if not updated:
+            return current_app.encode_error(Errors.BlobConflict)
+        current_app.note_write(current_user.id)
+        current_app.change_feed.publish(blob_topic())
+
+        result = {'id': blob_id, 'version': base + 1, 'digest': digest,
+                  'updates_left': updates_left - 1}
         return current_app.encode_success(result)
 
 
@@ -222,19 +428,96 @@ class User(Resource):
 
     @login_required
     def post(self):
-        """Return the blobs stored for this user."""
+        """
+        Return the blobs stored for this user.
+
+        Optional parameters:
+            * count [integer] - if set, return only the number of blobs
+            * etag [text]     - ETag from a previous response
+            * known [object]  - blob ID -> version already held by the client
+
+        When etag or known is given, the result is an object:
+            * etag [text]       - identifies the current set of blobs
+            * modified [bool]   - false if etag is still current
+            * blobs [list]      - blobs that are new or changed since known
+            * removed [list]    - IDs in known that no longer exist
+        """
         only_count = int(g.payload.get('count', 0))
+        etag = g.payload.get('etag')
+        known = g.payload.get('known')
 
         blobs = current_app.session.query(db.WalletBlob).filter(
             db.WalletBlob.user_id == current_user.id)
 
-        if only_count:
-            # Return the number of blobs stored.
-            result = {'num': blobs.count()}
-        else:
-            # Return the actual blobs.
-            result = list(format_blob(*blobs))
+        with current_app.replica(current_user.id):
+            if only_count:
+                # Return the number of blobs stored.
+                result = {'num': blobs.count()}
+            elif etag is None and known is None:
+                # Return the actual blobs.
+                blobs = blobs.options(db.undefer(db.WalletBlob.blob))
+                result = list(format_blob(*blobs))
+            else:
+                result = changed_blobs(blobs, etag, known or {})
+
+        return current_app.encode_success(result)
+
+
+class UserChanges(Resource):
+
+    @login_required
+    def post(self):
+        """
+        Wait for the blobs of this user to change.
+
+        Parameters required from the client:
+            * etag [text]    - ETag from a previous response
+
+        Optional parameters:
+            * known [object] - blob ID -> version held by the client
+            * wait [integer] - seconds to wait for a change, at most 30
+
+        Returns, as soon as something changed or once wait expires:
+            * etag [text]      - identifies the current set of blobs
+            * modified [bool]  - false if etag is still current
+            * changed [list]   - {id, version} of the blobs that are new or
+                                 changed since known (all when not given)
+            * removed [list]   - IDs in known that no longer exist
+        """
+        etag = g.payload.get('etag')
+        known = g.payload.get('known') or {}
+        wait = int(g.payload.get('wait', 30))
+        if etag is None:
+            return current_app.encode_error(Errors.MissingArguments)
 
+        feed = current_app.change_feed
+        topic = blob_topic()
+        # Read the sequence first so a change made while querying still
+        # ends the wait.
+        seq = feed.current(topic)
+        versions = blob_versions()
+        if blobs_etag(versions) == etag and wait > 0:
+            # Do not hold a database connection while waiting.
+            current_app.session.close()
+            try:
+                moved = feed.wait(topic, seq, wait)
+            except PoolBusy:
+                logging.error("Too many requests waiting for changes")
+                return current_app.encode_error(Errors.ServerBusy, 503)
+            if moved:
+                versions = blob_versions()
+
+        current = blobs_etag(versions)
+        result = {'etag': current, 'modified': current != etag,
+                  'changed': [], 'removed': []}
+        if result['modified']:
+            stored = dict(versions)
+            result['changed'] = [
+                {'id': blob_id, 'version': version}
+                for blob_id, version in versions
+                if known.get(blob_id) != version]
+            result['removed'] = [blob_id for blob_id in known
+                                 if blob_id not in stored]
         return current_app.encode_success(result)
 
 
@@ -245,3 +528,4 @@ api.add_resource(UserSignup, '/user/signup')
 api.add_resource(UserData, '/user/data')
 api.add_resource(UserStoreBlob, '/user/blob')
 api.add_resource(User, '/user')
+api.add_resource(UserChanges, '/user/changes')
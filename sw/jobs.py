@@ -0,0 +1,98 @@
+"""
+Background jobs for requests that would otherwise keep a worker waiting
+on a slow backend, such as a cosigner joining a wallet.
+"""
+import time
+import uuid
+import logging
+import threading
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+from .error import ErrorCode, Errors
+from .offload import PoolBusy
+from .util import ProcessLocal
+
+__all__ = ['JobRunner']
+
+
+class JobRunner(object):
+    """
+    Run jobs in size background threads (greenlets under gevent) of this
+    worker, outside of any request. A job is func(*args), called within
+    an app context; it returns a dict on success or an ErrorCode.
+
+    The state of each job is kept in store for ttl seconds, so with a
+    SQLiteStore any worker on the host can report it. A job still
+    pending after timeout seconds, for example because its worker died,
+    is reported as failed. At most max_pending jobs wait to run, further
+    ones are refused with PoolBusy.
+    """
+
+    def __init__(self, app, store, size=4, max_pending=64, ttl=3600,
+                 timeout=300):
+        self.app = app
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self._queue = ProcessLocal(self._start)
+
+    def _start(self):
+        queue = Queue(self.max_pending)
+        for _ in range(self.size):
+            thread = threading.Thread(target=self._serve, args=(queue,))
+            thread.daemon = True
+            thread.start()
+        return queue
+
+    def submit(self, owner, func, *args):
+        """Queue func(*args) on behalf of owner and return the job id."""
+        queue = self._queue.get()
+        job_id = str(uuid.uuid4())
+        self._save(job_id, {'owner': owner, 'status': 'pending',
+                            'at': time.time()})
+        try:
+            queue.put_nowait((job_id, owner, func, args))
+        except Full:
+            self.store.delete('job:' + job_id)
+            raise PoolBusy()
+        return job_id
+
+    def status(self, job_id, owner):
+        """Return the state of a job submitted by owner, or None."""
+        job = self.store.get('job:' + job_id)
+        if job is None or job['owner'] != owner:
+            return None
+        job = dict(job)
+        if (job['status'] == 'pending' and
+                time.time() - job['at'] > self.timeout):
+            job.update(status='failed', error=Errors.GenericError.reason,
+                       code=Errors.GenericError.code)
+        return job
+
+    def _save(self, job_id, job):
+        self.store.set('job:' + job_id, job, self.ttl)
+
+    def _serve(self, queue):
+        while True:
+            job_id, owner, func, args = queue.get()
+            job = {'owner': owner, 'at': time.time()}
+            try:
+                with self.app.app_context():
+                    result = func(*args)
+            except Exception:
+                logging.exception("Job {} failed".format(job_id))
+                result = Errors.GenericError
+            finally:
+                self.app.session.remove()
+
+            if isinstance(result, ErrorCode):
+                job.update(status='failed', error=result.reason,
+                           code=result.code)
+            else:
+                job.update(status='done', result=result)
+            self._save(job_id, job)
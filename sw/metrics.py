@@ -0,0 +1,101 @@
+"""
+Process-wide counters and latency histograms.
+"""
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+__all__ = ['Counter', 'Histogram', 'counter', 'histogram', 'timed',
+           'register', 'snapshot']
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10)
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None if not self.count else float('inf')
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.total,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+_registry = {}
+_lock = threading.Lock()
+
+
+def _get(name, cls):
+    metric = _registry.get(name)
+    if metric is None:
+        with _lock:
+            metric = _registry.setdefault(name, cls())
+    return metric
+
+
+def counter(name):
+    return _get(name, Counter)
+
+
+def histogram(name):
+    return _get(name, Histogram)
+
+
+@contextmanager
+def timed(name):
+    """Record the time spent in the with block in histogram name."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        histogram(name).observe(time.time() - start)
+
+
+def register(name, func):
+    """Report the result of func() as metric name in snapshots."""
+    _registry[name] = func
+
+
+def snapshot():
+    result = {}
+    for name, metric in list(_registry.items()):
+        result[name] = metric() if callable(metric) else metric.snapshot()
+    return result
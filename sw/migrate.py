@@ -0,0 +1,198 @@
+"""
+Versioned schema migrations. Databases created by sw.database start at
+the latest version; older ones are brought up to date with
+
+    DEGLET_CONFIG=config/default.json python -m sw.migrate [--to N]
+
+which applies, in order and each in its own transaction, the migrations
+newer than the version recorded in the schema_version table. With
+api_database.shards every shard is migrated.
+"""
+import os
+import json
+import hashlib
+import logging
+import argparse
+
+from sqlalchemy import (MetaData, Table, Column, Integer, String, DateTime,
+                        func, select, inspect, cast, bindparam, type_coerce)
+from sqlalchemy.sql import table, column
+
+from . import database as db
+
+__all__ = ['MIGRATIONS', 'current_version', 'upgrade', 'stamp']
+
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String, nullable=False),
+    Column('applied_at', DateTime, default=func.now(), nullable=False))
+
+# (version, description, apply), apply(connection) runs the migration.
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(apply):
+        MIGRATIONS.append((version, description, apply))
+        return apply
+    return register
+
+
+def _quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def add_column(conn, tablename, name, ddl):
+    """ALTER TABLE tablename ADD COLUMN name ddl, unless it exists."""
+    existing = [entry['name']
+                for entry in inspect(conn).get_columns(tablename)]
+    if name in existing:
+        return False
+    conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+        _quote(conn, tablename), _quote(conn, name), ddl))
+    return True
+
+
+def create_index(conn, model, name):
+    """Create the index called name declared on model, unless it exists."""
+    mapped = model.__table__
+    existing = [entry['name'] for entry in inspect(conn).get_indexes(
+        mapped.name)]
+    if name in existing:
+        return
+    index, = [entry for entry in mapped.indexes if entry.name == name]
+    index.create(conn)
+
+
+@migration(1, 'blob versions, blob quota counter and cosigner addresses')
+def add_blob_metadata(conn):
+    add_column(conn, 'user', 'blob_count', 'INTEGER DEFAULT 0 NOT NULL')
+    add_column(conn, 'wallet_blob', 'version', 'INTEGER DEFAULT 1 NOT NULL')
+    add_column(conn, 'wallet_blob', 'digest', 'VARCHAR(40)')
+    add_column(conn, 'wallet_blob', 'blob_length', 'INTEGER')
+    create_index(conn, db.User, 'ix_user_username_check')
+    db.CosignerAddress.__table__.create(conn, checkfirst=True)
+
+    user = table('user', column('id'), column('blob_count'))
+    blob = table('wallet_blob', column('id'), column('user_id'),
+                 column('blob'), column('digest'), column('blob_length'))
+    conn.execute(user.update().values(blob_count=select(
+        [func.count()]).where(
+            cast(blob.c.user_id, Integer) == user.c.id).as_scalar()))
+
+    # Fill in digest and blob_length, reading the blobs a batch at a time.
+    stored = type_coerce(blob.c.blob, db.CompressedBinary)
+    update = blob.update().where(blob.c.id == bindparam('pk')).values(
+        digest=bindparam('digest'), blob_length=bindparam('length'))
+    last = None
+    while True:
+        query = select([blob.c.id, stored]).where(
+            blob.c.digest == None).order_by(blob.c.id).limit(500)
+        if last is not None:
+            query = query.where(blob.c.id > last)
+        chunk = conn.execute(query).fetchall()
+        if not chunk:
+            break
+        last = chunk[-1][0]
+        params = [{'pk': pk, 'digest': hashlib.sha1(value).hexdigest(),
+                   'length': len(value)}
+                  for pk, value in chunk if value is not None]
+        if params:
+            conn.execute(update, params)
+
+
+@migration(2, 'wallet_blob.user_id is an integer, like user.id')
+def wallet_blob_user_id(conn):
+    name = conn.dialect.name
+    if name == 'postgresql':
+        conn.execute('ALTER TABLE wallet_blob ALTER COLUMN user_id '
+                     'TYPE INTEGER USING user_id::integer')
+    elif name == 'mysql':
+        conn.execute('ALTER TABLE wallet_blob MODIFY user_id INTEGER '
+                     'NOT NULL')
+    elif name == 'sqlite':
+        # SQLite cannot change a column type: build the table again as
+        # declared now, copy the rows and swap the two.
+        meta = MetaData()
+        db.User.__table__.tometadata(meta)
+        new = db.WalletBlob.__table__.tometadata(
+            meta, name='wallet_blob_new')
+        new.create(conn)
+        existing = [entry['name'] for entry in inspect(conn).get_columns(
+            'wallet_blob')]
+        names = [entry.name for entry in new.columns
+                 if entry.name in existing]
+        old = table('wallet_blob', *[column(entry) for entry in names])
+        values = [cast(old.c.user_id, Integer) if entry == 'user_id'
+                  else old.c[entry] for entry in names]
+        conn.execute(new.insert().from_select(names, select(values)))
+        conn.execute('DROP TABLE wallet_blob')
+        conn.execute('ALTER TABLE wallet_blob_new RENAME TO wallet_blob')
+    else:
+        raise Exception("Migration 2 does not support {}".format(name))
+
+
+@migration(3, 'indexes for the wallet_blob and cosigner_wallet lookups')
+def add_lookup_indexes(conn):
+    create_index(conn, db.WalletBlob, 'ix_wallet_blob_user')
+    create_index(conn, db.CosignerWallet, 'ix_cosigner_wallet_user')
+
+
+def current_version(engine):
+    schema_version.create(engine, checkfirst=True)
+    return engine.execute(
+        select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def upgrade(engine, target=None):
+    """Apply the migrations after the current version, up to target."""
+    version = current_version(engine)
+    applied = []
+    for number, description, apply in sorted(MIGRATIONS):
+        if number <= version or (target is not None and number > target):
+            continue
+        logging.info("Migration {}: {}".format(number, description))
+        with engine.begin() as conn:
+            apply(conn)
+            conn.execute(schema_version.insert(), version=number,
+                         description=description)
+        applied.append(number)
+    return applied
+
+
+def stamp(engine):
+    """Record a database created with the latest schema as such."""
+    if current_version(engine):
+        return
+    with engine.begin() as conn:
+        conn.execute(schema_version.insert(), [
+            {'version': number, 'description': description}
+            for number, description, _ in MIGRATIONS])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate the schema.')
+    parser.add_argument('--to', type=int, help='stop at this version')
+    parser.add_argument('--status', action='store_true',
+                        help='only show the current version')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    configpath = os.getenv('DEGLET_CONFIG')
+    if not configpath:
+        raise Exception("DEGLET_CONFIG not specified in the environment")
+    dbcfg = json.load(open(configpath))['api_database']
+    configs = dbcfg.get('shards') or [dbcfg['engine']]
+
+    latest = max(number for number, _, _ in MIGRATIONS)
+    for cfg in configs:
+        engine = db.setup_engine(**cfg)
+        if not args.status:
+            upgrade(engine, args.to)
+        print('{}: version {} of {}'.format(
+            engine.url, current_version(engine), latest))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Replay protection. A signed request is only accepted when its nonce (the
+iat claim) is greater than the last nonce accepted for the same key.
+"""
+import time
+import atexit
+import logging
+import threading
+
+from sqlalchemy import bindparam, or_
+
+from . import database as db
+from .store import SQLiteStore
+
+__all__ = ['DatabaseNonceGuard', 'StoreNonceGuard', 'from_config']
+
+
+def _advance(key_id, nonce):
+    """UPDATE that moves last_nonce forward, and only forward."""
+    return db.UserKey.__table__.update().where(
+        db.UserKey.id == key_id).where(
+            or_(db.UserKey.last_nonce == None,
+                db.UserKey.last_nonce < nonce)).values(last_nonce=nonce)
+
+
+class DatabaseNonceGuard(object):
+    """
+    Check and advance user_key.last_nonce with one conditional UPDATE.
+    Every accepted request costs a commit, but the guarantee holds across
+    any number of processes and hosts.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def accept(self, userkey, nonce):
+        result = self.session.execute(_advance(userkey.id, nonce))
+        self.session.commit()
+        return result.rowcount > 0
+
+
+class StoreNonceGuard(object):
+    """
+    Keep the last nonce of each key in a store and write it back to
+    user_key in batches, taking the commit off the request path.
+
+    Replays are detected among the processes sharing the store, so it
+    must be a SQLiteStore shared by every worker that serves the keys: a
+    store private to a worker would let another one accept a replay. A
+    nonce that has not been flushed yet is lost if the process dies, so a
+    request signed within the last flush_interval seconds could be
+    replayed after an unclean restart.
+    """
+
+    def __init__(self, session, engines, store, flush_interval=5,
+                 flush_size=100, ttl=86400):
+        self.session = session
+        # One engine per shard, a single one when not sharded.
+        self.engines = engines
+        self.store = store
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        # Must be well above flush_interval: an expired entry is reloaded
+        # from user_key.
+        self.ttl = ttl
+        self._pending = {}
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def accept(self, userkey, nonce):
+        key = (userkey.shard, userkey.id)
+        name = 'nonce:{}:{}'.format(*key)
+        loaded = []
+
+        def advance(last):
+            if last is None:
+                if not loaded:
+                    # No entry, or it expired: ask again once user_key
+                    # has been read, outside of the store's lock.
+                    return None, None
+                last = loaded[0]
+            if last is not None and nonce <= last:
+                return last, False
+            return nonce, True
+
+        accepted = self.store.update(name, advance, self.ttl)
+        if accepted is None:
+            loaded.append(self.session.query(db.UserKey.last_nonce).filter(
+                db.UserKey.id == userkey.id).scalar())
+            self.session.commit()
+            accepted = self.store.update(name, advance, self.ttl)
+        if accepted:
+            self._enqueue(key, nonce)
+        return accepted
+
+    def _enqueue(self, key, nonce):
+        with self._lock:
+            self._pending[key] = max(nonce, self._pending.get(key, 0))
+            due = (len(self._pending) >= self.flush_size or
+                   time.time() - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write the pending high-water marks to user_key."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        if not pending:
+            return
+
+        stmt = _advance(bindparam('key_id'), bindparam('nonce'))
+        by_shard = {}
+        for (shard, key_id), nonce in pending.items():
+            by_shard.setdefault(shard, []).append(
+                {'key_id': key_id, 'nonce': nonce})
+
+        for shard, params in by_shard.items():
+            try:
+                with self.engines[shard].begin() as conn:
+                    conn.execute(stmt, params)
+            except Exception:
+                logging.exception("Failed to flush {} nonces".format(
+                    len(params)))
+                with self._lock:
+                    for entry in params:
+                        key = (shard, entry['key_id'])
+                        self._pending[key] = max(
+                            entry['nonce'], self._pending.get(key, 0))
+
+
+def from_config(session, engines, store, cfg=None):
+    """Build a nonce guard from a config like {"type": "store", ...}."""
+    cfg = dict(cfg or {})
+    kind = cfg.pop('type', 'database')
+    if kind == 'database':
+        return DatabaseNonceGuard(session)
+    elif kind == 'store':
+        if not isinstance(store, SQLiteStore):
+            raise Exception("Invalid config: the store nonce guard needs a "
+                            "sqlite local_store shared by every worker")
+        return StoreNonceGuard(session, engines, store, **cfg)
+    raise Exception("Invalid config: unknown nonce guard {}".format(kind))
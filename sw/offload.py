@@ -0,0 +1,121 @@
+"""
+Run CPU-bound work, such as signature checks, away from the gevent hub so
+a slow operation does not stall every other greenlet of the worker.
+"""
+import threading
+import multiprocessing
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+try:
+    # Native threads even when the worker has been monkey patched.
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    from multiprocessing.pool import ThreadPool
+
+from .util import ProcessLocal
+
+__all__ = ['Offload', 'PoolBusy']
+
+
+class PoolBusy(Exception):
+    """Raised when too many tasks are already waiting for the pool."""
+
+
+def _serve(conn, initializer, initargs):
+    """Loop run by each child process of a process Offload."""
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        func, args = conn.recv()
+        try:
+            conn.send((True, func(*args)))
+        except Exception as err:
+            conn.send((False, err))
+
+
+def _receive(conn, timeout):
+    if not conn.poll(timeout):
+        raise multiprocessing.TimeoutError()
+    return conn.recv()
+
+
+class Offload(object):
+    """
+    Execute functions in a pool of native threads ("thread") or of child
+    processes ("process"). Callers block only their own greenlet.
+
+    At most max_pending calls may be queued or running at once, further
+    calls fail immediately with PoolBusy so the worker sheds load instead
+    of accumulating it. For the process kind, func and its arguments must
+    be picklable and initializer(*initargs) runs once in each child.
+    """
+
+    def __init__(self, kind='thread', size=2, max_pending=32, timeout=10,
+                 initializer=None, initargs=()):
+        if kind not in ('thread', 'process'):
+            raise Exception("Invalid config: unknown offload kind {}".format(
+                kind))
+        self.kind = kind
+        self.size = size
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.initializer = initializer
+        self.initargs = initargs
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._pools = ProcessLocal(self._start)
+
+    def _start(self):
+        threads = ThreadPool(self.size)
+        children = None
+        if self.kind == 'process':
+            children = Queue()
+            for _ in range(self.size):
+                children.put(self._spawn())
+        return threads, children
+
+    def _spawn(self):
+        parent, child = multiprocessing.Pipe()
+        proc = multiprocessing.Process(
+            target=_serve, args=(child, self.initializer, self.initargs))
+        proc.daemon = True
+        proc.start()
+        return proc, parent
+
+    def run(self, func, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise PoolBusy()
+            self._pending += 1
+        try:
+            threads, children = self._pools.get()
+            if self.kind == 'thread':
+                return threads.apply(func, args)
+            return self._run_child(threads, children, func, args)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _run_child(self, threads, children, func, args):
+        proc, conn = children.get()
+        try:
+            conn.send((func, args))
+            # Wait for the answer in a native thread, keeping the hub free.
+            ok, result = threads.apply(_receive, (conn, self.timeout))
+        except Exception:
+            # The child is in an unknown state, replace it.
+            proc.terminate()
+            proc, conn = self._spawn()
+            raise
+        finally:
+            children.put((proc, conn))
+        if not ok:
+            raise result
+        return result
+
+    def stats(self):
+        return {'kind': self.kind, 'size': self.size,
+                'pending': self._pending}
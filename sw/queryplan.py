@@ -0,0 +1,162 @@
+"""
+Check that the queries made by the request handlers are answered from
+an index. Loads synthetic users into an empty database, then prints the
+plan of each query and fails if one is worse than expected.
+
+    python -m sw.queryplan [--users 1000000] [--url postgresql:///plans]
+
+The default URL is a temporary SQLite file. A database that already
+holds users is reused as it is.
+"""
+import os
+import sys
+import tempfile
+import argparse
+
+from sqlalchemy import create_engine, select, func
+
+from . import database as db
+
+__all__ = ['QUERIES', 'load', 'classify']
+
+User = db.User.__table__
+UserKey = db.UserKey.__table__
+WalletBlob = db.WalletBlob.__table__
+CosignerWallet = db.CosignerWallet.__table__
+CosignerAddress = db.CosignerAddress.__table__
+
+# Plans from best to worst.
+RANKS = ['index-only', 'index', 'scan']
+
+# (name, statement, worst plan accepted), n stands for a user in the
+# middle of the data set.
+QUERIES = [
+    ('key lookup (auth)', lambda n: select(
+        [UserKey.c.id, UserKey.c.user_id, User.c.username,
+         UserKey.c.key_type]).select_from(UserKey.join(User)).where(
+             UserKey.c.key == 'key{}'.format(n)), 'index'),
+    ('salt lookup (/user/data)', lambda n: select(
+        [User.c.salt, User.c.itercount]).where(
+            (User.c.username == 'user{}'.format(n)) &
+            (User.c.user_check == 'abcdef')), 'index'),
+    ('blob versions (/user, /user/changes)', lambda n: select(
+        [WalletBlob.c.id, WalletBlob.c.version]).where(
+            WalletBlob.c.user_id == n), 'index-only'),
+    ('blob count (/user)', lambda n: select([func.count()]).where(
+        WalletBlob.c.user_id == n), 'index-only'),
+    ('blob update (/user/blob)', lambda n: select(
+        [WalletBlob.c.version, WalletBlob.c.updates_left]).where(
+            (WalletBlob.c.user_id == n) &
+            (WalletBlob.c.id == blob_id(n, 0))), 'index'),
+    ('cosigner wallet (/address, /balance)', lambda n: select(
+        [CosignerWallet]).where(
+            (CosignerWallet.c.user_id == n) &
+            (CosignerWallet.c.wallet_id == blob_id(n, 0))), 'index'),
+    ('cosigner wallets (/balance/batch)', lambda n: select(
+        [CosignerWallet.c.wallet_id, CosignerWallet.c.wallet]).where(
+            CosignerWallet.c.user_id == n), 'index'),
+    ('unused addresses (address pool)', lambda n: select(
+        [CosignerAddress.c.id]).where(
+            (CosignerAddress.c.cosigner_id == n) &
+            (CosignerAddress.c.issued_at == None)).order_by(
+                CosignerAddress.c.path_index).limit(5), 'index-only'),
+]
+
+
+def blob_id(user, num):
+    return '{:08d}-0000-0000-0000-{:012d}'.format(num, user)
+
+
+def load(engine, users, batch=10000):
+    """Insert users, each with a key, two blobs and a cosigner wallet."""
+    for start in range(1, users + 1, batch):
+        ids = range(start, min(start + batch, users + 1))
+        with engine.begin() as conn:
+            conn.execute(User.insert(), [
+                {'id': n, 'salt': 'salt{}'.format(n),
+                 'username': 'user{}'.format(n), 'user_check': 'abcdef',
+                 'itercount': 10000, 'blob_count': 2} for n in ids])
+            conn.execute(UserKey.insert(), [
+                {'id': n, 'user_id': n, 'key': 'key{}'.format(n),
+                 'key_type': 'publickey', 'last_nonce': 0} for n in ids])
+            conn.execute(WalletBlob.insert(), [
+                {'id': blob_id(n, num), 'user_id': n, 'blob': b'blob',
+                 'blob_length': 4, 'updates_left': 32, 'version': 1}
+                for n in ids for num in (0, 1)])
+            conn.execute(CosignerWallet.insert(), [
+                {'id': n, 'user_id': n, 'wallet': b'wallet',
+                 'wallet_id': blob_id(n, 0)} for n in ids])
+            conn.execute(CosignerAddress.insert(), [
+                {'cosigner_id': n, 'address': 'addr{}-{}'.format(n, index),
+                 'path': 'm/0/{}'.format(index), 'path_index': index}
+                for n in ids for index in range(3)])
+
+
+def explain(engine, stmt):
+    sql = str(stmt.compile(dialect=engine.dialect,
+                           compile_kwargs={'literal_binds': True}))
+    if engine.dialect.name == 'sqlite':
+        rows = engine.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+        return [row[-1] for row in rows]
+    return [row[0] for row in engine.execute('EXPLAIN ' + sql).fetchall()]
+
+
+def classify(dialect, plan):
+    """Return the worst access in plan, one of RANKS."""
+    worst = 0
+    for line in plan:
+        if dialect == 'sqlite':
+            if line.startswith('SCAN') and 'INDEX' not in line:
+                rank = 2
+            elif 'COVERING INDEX' in line or 'INTEGER PRIMARY KEY' in line:
+                rank = 0
+            elif 'INDEX' in line or 'PRIMARY KEY' in line:
+                rank = 1
+            else:
+                continue
+        else:
+            if 'Seq Scan' in line:
+                rank = 2
+            elif 'Index Only Scan' in line:
+                rank = 0
+            elif 'Index Scan' in line or 'Bitmap' in line:
+                rank = 1
+            else:
+                continue
+        worst = max(worst, rank)
+    return RANKS[worst]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check query plans.')
+    parser.add_argument('--url', help='database to use, a temporary '
+                        'SQLite file by default')
+    parser.add_argument('--users', type=int, default=100000,
+                        help='synthetic users to load')
+    args = parser.parse_args()
+
+    url = args.url or 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'plans.db')
+    engine = create_engine(url)
+    db.Base.metadata.create_all(engine)
+    if not engine.execute(select([func.count()]).select_from(User)).scalar():
+        print('Loading {} users into {}'.format(args.users, url))
+        load(engine, args.users)
+        engine.execute('ANALYZE')
+
+    failed = 0
+    middle = max(args.users // 2, 1)
+    for name, build, expected in QUERIES:
+        plan = explain(engine, build(middle))
+        found = classify(engine.dialect.name, plan)
+        ok = RANKS.index(found) <= RANKS.index(expected)
+        failed += not ok
+        print('{} {}: {} (expected {})'.format(
+            'ok  ' if ok else 'FAIL', name, found, expected))
+        for line in plan:
+            print('       ' + line)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Token bucket admission control, applied before a request reaches any
+signature check or database query.
+"""
+import json
+import time
+import base64
+
+__all__ = ['RateLimiter', 'peek_kid']
+
+# Longest JWS header worth decoding, real ones are around 150 bytes.
+MAX_HEADER = 1024
+
+
+def peek_kid(data):
+    """
+    Return the kid in the header of the compact JWS data, without
+    validating anything, or None if there is no such header.
+    """
+    header = data.split(b'.', 1)[0]
+    if len(header) > MAX_HEADER:
+        return None
+    try:
+        header += b'=' * (-len(header) % 4)
+        kid = json.loads(base64.urlsafe_b64decode(header).decode('utf8'))
+        kid = kid.get('kid')
+    except Exception:
+        return None
+    if not isinstance(kid, (str, type(u''))) or len(kid) > MAX_HEADER:
+        return None
+    return kid
+
+
+def _take(rate, burst, now):
+    """Build a store update taking one token from a bucket."""
+    def take(bucket):
+        tokens, last = bucket or (burst, now)
+        tokens = min(burst, tokens + (now - last) * rate)
+        if tokens < 1:
+            return [tokens, now], False
+        return [tokens - 1, now], True
+    return take
+
+
+def _give_back(burst):
+    """Build a store update returning the token taken by _take."""
+    def give_back(bucket):
+        tokens, last = bucket
+        return [min(burst, tokens + 1), last], None
+    return give_back
+
+
+class RateLimiter(object):
+    """
+    Limit how often a client IP, and the key named by the kid of a
+    request, may call the API. Every limit is a {"rate": tokens per
+    second, "burst": bucket size} pair:
+
+        * ip        - for each client IP
+        * kid       - for each key, unless key_types has one for its type
+        * key_types - for each key of a given KeyType
+        * endpoints - for each key (or IP when there is no kid) calling
+                      that path, on top of the limits above; the
+                      operations of a /batch count as calls to their
+                      own paths
+
+    Buckets live in store (see sw.store), so they are shared by every
+    worker when it is a SQLiteStore. Every bucket checked is then a write
+    transaction on that one file, which workers wait on in turn; a
+    MemoryStore keeps them per worker, with limits that much looser.
+    """
+
+    def __init__(self, store, ip=None, kid=None, key_types=None,
+                 endpoints=None):
+        self.store = store
+        self.ip = ip
+        self.kid = kid
+        self.key_types = key_types or {}
+        self.endpoints = endpoints or {}
+
+    def allow(self, path, ip, kid=None, key_type=None, batched=False):
+        """
+        Take a token from every bucket that applies, or from none of
+        them and return False if one is empty. A batched operation only
+        counts against its path, the batch itself took the others.
+        """
+        checks = []
+        if self.ip and ip and not batched:
+            checks.append(('ip:{}'.format(ip), self.ip))
+        if kid and not batched:
+            limit = self.key_types.get(key_type, self.kid)
+            if limit:
+                checks.append(('kid:{}'.format(kid), limit))
+        limit = self.endpoints.get(path)
+        if limit and (kid or ip):
+            checks.append(('path:{}:{}'.format(path, kid or ip), limit))
+
+        now = time.time()
+        taken = []
+        for name, limit in checks:
+            rate, burst = float(limit['rate']), limit['burst']
+            # An untouched bucket is full again after this long.
+            ttl = int(burst / rate) + 1
+            if not self.store.update('rate:' + name,
+                                     _take(rate, burst, now), ttl):
+                # Refused, so do not charge the buckets already taken.
+                for name, burst, ttl in taken:
+                    self.store.update('rate:' + name, _give_back(burst), ttl)
+                return False
+            taken.append((name, burst, ttl))
+        return True
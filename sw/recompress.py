@@ -0,0 +1,194 @@
+"""
+Compress the wallet_blob and cosigner_wallet payloads stored before
+those columns used database.CompressedBinary, and report how much
+space that saves.
+
+    DEGLET_CONFIG=config/default.json python -m sw.recompress [--dry-run]
+
+With --synthetic N it instead loads N users with uncompressed payloads
+shaped like the real ones into an empty database, a temporary SQLite
+file unless --url is given, and compresses those.
+"""
+import os
+import json
+import time
+import base64
+import random
+import tempfile
+import argparse
+import datetime
+
+from sqlalchemy import (select, bindparam, type_coerce, LargeBinary,
+                        create_engine)
+from sqlalchemy.sql import table as raw_table, column as raw_column
+
+from . import database as db
+from .constant import MAX_BLOBCOUNT, MAX_BLOBLEN
+
+TARGETS = [(db.WalletBlob.__table__, 'blob'),
+           (db.CosignerWallet.__table__, 'wallet')]
+
+MARKERS = (db.CompressedBinary.RAW, db.CompressedBinary.ZLIB,
+           db.CompressedBinary.ZSTD)
+
+
+def _hex(size):
+    return base64.b16encode(os.urandom(size)).decode('ascii').lower()
+
+
+def synthetic_blob():
+    """A client-encrypted wallet, as sent to /user/blob."""
+    size = random.randint(MAX_BLOBLEN // 8, MAX_BLOBLEN * 9 // 16)
+    return json.dumps({
+        'iv': base64.b64encode(os.urandom(16)).decode('ascii'), 'v': 1,
+        'iter': 10000, 'ks': 256, 'ts': 64, 'mode': 'ccm', 'adata': '',
+        'cipher': 'aes', 'salt': base64.b64encode(os.urandom(8)).decode(
+            'ascii'),
+        'ct': base64.b64encode(os.urandom(size)).decode('ascii')}).encode(
+            'ascii')
+
+
+def synthetic_wallet(wallet_id, n=3):
+    """Credentials exported by the cosigner after joining a wallet."""
+    xpubs = ['xpub' + _hex(53) for _ in range(n)]
+    return json.dumps({
+        'network': 'livenet', 'xPrivKey': 'xprv' + _hex(53),
+        'xPubKey': xpubs[0], 'requestPrivKey': _hex(32),
+        'requestPubKey': _hex(33), 'copayerId': _hex(32),
+        'publicKeyRing': [{'xPubKey': xpub, 'requestPubKey': _hex(33)}
+                          for xpub in xpubs],
+        'walletId': wallet_id, 'walletName': 'Wallet', 'm': 2, 'n': n,
+        'walletPrivKey': _hex(32), 'personalEncryptingKey': _hex(16),
+        'sharedEncryptingKey': _hex(16), 'copayerName': 'cosigner',
+        'derivationStrategy': 'BIP44', 'account': 0,
+        'addressType': 'P2SH'}).encode('ascii')
+
+
+def load(engine, users, batch=1000):
+    """
+    Insert users with MAX_BLOBCOUNT // 2 blobs each and a cosigner wallet
+    for the first one, storing the payloads uncompressed.
+    """
+    user = db.User.__table__
+    # Insert the payloads as they are, like before CompressedBinary.
+    blob = raw_table('wallet_blob', *[
+        raw_column(name, LargeBinary if name == 'blob' else None)
+        for name in ('id', 'user_id', 'blob', 'blob_length', 'updates_left',
+                     'version', 'created_at')])
+    wallet = raw_table('cosigner_wallet', *[
+        raw_column(name, LargeBinary if name == 'wallet' else None)
+        for name in ('id', 'user_id', 'wallet_id', 'wallet')])
+    now = datetime.datetime.utcnow()
+    for start in range(1, users + 1, batch):
+        ids = range(start, min(start + batch, users + 1))
+        blobs = [{'id': '{:08d}-0000-0000-0000-{:012d}'.format(num, n),
+                  'user_id': n, 'blob': synthetic_blob(), 'updates_left': 32,
+                  'version': 1, 'created_at': now} for n in ids
+                 for num in range(MAX_BLOBCOUNT // 2)]
+        for entry in blobs:
+            entry['blob_length'] = len(entry['blob'])
+        with engine.begin() as conn:
+            conn.execute(user.insert(), [
+                {'id': n, 'salt': 'salt{}'.format(n),
+                 'username': 'user{}'.format(n), 'user_check': 'abcdef',
+                 'itercount': 10000, 'blob_count': MAX_BLOBCOUNT // 2}
+                for n in ids])
+            conn.execute(blob.insert(), blobs)
+            conn.execute(wallet.insert(), [
+                {'id': n, 'user_id': n, 'wallet_id': entry['id'],
+                 'wallet': synthetic_wallet(entry['id'])}
+                for n, entry in zip(ids, blobs[::MAX_BLOBCOUNT // 2])])
+
+
+def recompress(engine, table, column, batch=500, dry_run=False):
+    """
+    Rewrite the uncompressed values of table.column, batch rows at a time
+    in primary key order. Return a dict with the number of rows, their
+    size before and after, and the time spent decoding them both ways.
+    """
+    pk = table.c.id
+    ctype = table.c[column].type
+    # Read the stored bytes as they are, without decompressing them.
+    stored = type_coerce(table.c[column], LargeBinary)
+    update = table.update().where(pk == bindparam('pk')).values(
+        {column: bindparam('payload')})
+
+    stats = {'rows': 0, 'before': 0, 'after': 0,
+             'read_raw': 0.0, 'read_compressed': 0.0}
+    last = None
+    while True:
+        query = select([pk, stored]).order_by(pk).limit(batch)
+        if last is not None:
+            query = query.where(pk > last)
+        chunk = engine.execute(query).fetchall()
+        if not chunk:
+            break
+        last = chunk[-1][0]
+
+        params = []
+        for key, value in chunk:
+            if value is None or bytes(value)[:1] in MARKERS:
+                continue
+            value = bytes(value)
+            packed = ctype.process_bind_param(value, engine.dialect)
+
+            start = time.time()
+            ctype.process_result_value(value, engine.dialect)
+            stats['read_raw'] += time.time() - start
+            start = time.time()
+            ctype.process_result_value(packed, engine.dialect)
+            stats['read_compressed'] += time.time() - start
+
+            stats['rows'] += 1
+            stats['before'] += len(value)
+            stats['after'] += len(packed)
+            # The column type compresses it again when writing.
+            params.append({'pk': key, 'payload': value})
+
+        if params and not dry_run:
+            with engine.begin() as conn:
+                conn.execute(update, params)
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--batch', type=int, default=500,
+                        help='rows read and written at a time')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report the savings')
+    parser.add_argument('--synthetic', type=int, metavar='USERS',
+                        help='load this many synthetic users and use them')
+    parser.add_argument('--url', help='database for --synthetic, a '
+                        'temporary SQLite file by default')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        url = args.url or 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'recompress.db')
+        engine = create_engine(url)
+        db.Base.metadata.create_all(engine)
+        print('Loading {} users into {}'.format(args.synthetic, url))
+        load(engine, args.synthetic)
+    else:
+        configpath = os.getenv('DEGLET_CONFIG')
+        if not configpath:
+            raise Exception("DEGLET_CONFIG not specified in the environment")
+        mod = json.load(open(configpath))
+        engine = db.setup_engine(**mod['api_database']['engine'])
+
+    for table, column in TARGETS:
+        stats = recompress(engine, table, column, args.batch, args.dry_run)
+        rows = stats['rows'] or 1
+        print('{}.{}: {} rows, {} -> {} bytes ({:.1%}), read {:.1f} -> '
+              '{:.1f} us/row'.format(
+                  table.name, column, stats['rows'], stats['before'],
+                  stats['after'],
+                  float(stats['after']) / (stats['before'] or 1),
+                  stats['read_raw'] / rows * 1e6,
+                  stats['read_compressed'] / rows * 1e6))
+
+
+if __name__ == "__main__":
+    main()
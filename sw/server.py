@@ -1,17 +1,31 @@
 import os
-import time
 import json
+import time
+import random
 import logging
 
-import requests
-from flask import Flask, Response, request
+from flask import Flask, Response, request, g, stream_with_context
 from flask.ext.cors import CORS
 from flask.ext.login import LoginManager
 import bitjws
 
 from . import auth
+from . import store
+from . import nonce
+from . import offload
+from . import metrics
 from . import database
-from .handler import user, serverwallet
+from .error import Errors
+from .ratelimit import RateLimiter, peek_kid
+from .shard import Directory
+from .cache import LRUCache, LoadingCache
+from .signer import Signer
+from .cosigner import CosignerClient
+from .addrpool import AddressPool
+from .jobs import JobRunner
+from .feed import ChangeFeed
+from .util import memory_usage
+from .handler import user, serverwallet, batch, stats
 
 logger = logging.getLogger("")
 logger.setLevel(logging.DEBUG)
@@ -22,46 +36,128 @@ ENVCFG = 'DEGLET_CONFIG'
 class Application(Flask):
     def __init__(self, config=None):
         super(Application, self).__init__(__name__)
-        self._privkey = None
+        started = time.time()
+        self.signer = None
         self._dbcfg = None
-        self._cosigner_server = None
+        self.cosigner_client = None
+        self.key_cache = None
+        self.store = None
+        self.nonce_guard = None
+        self.balance_cache = None
+        self.address_pool = None
+        self.userdata_cache = None
+        self.userdata_negative_ttl = None
+        self.verifier = None
+        self.directory = None
+        self.rate_limiter = None
+        self.join_jobs = None
+        self.change_feed = None
+        self.engines = []
+        self._proxies = 0
         self._load_config(config)
+        self._setup_offload()
         self._setup_auth()
         self._setup_api()
+        self._setup_ratelimit()
 
         self.teardown_appcontext(self._shutdown_session)
 
         CORS(self)
+        logging.info("Application built in {:.2f}s, {}".format(
+            time.time() - started, memory_usage()))
+
+    def after_fork(self):
+        """
+        Prepare a worker forked from a master that built this app, see
+        preload_app in gunicorn.conf.py. The connections pooled by the
+        engines must not be shared with other processes; the master does
+        not query the database, so dropping them loses nothing. The other
+        pools, threads and connections are util.ProcessLocal values,
+        made again on first use in a new process.
+        """
+        for engine in self.engines:
+            engine.dispose()
+        # Do not make the same random choices in every worker.
+        random.seed()
 
     def encode_success(self, obj=None):
         """Encode a successful message in JWS."""
-        signed = self._sign(obj)
-        return Response(signed)
+        return self._encode(obj)
 
     def encode_error(self, err, code=400):
         """Encode error messages in JWS."""
         obj = {'error': err.reason, 'code': err.code}
-        signed = self._sign(obj)
-        return Response(signed, status=code)
+        # Errors are always the same, so their signature can be reused.
+        return self._encode(obj, code, cacheable=True)
+
+    def encode_stream(self, pages):
+        """
+        Encode each object produced by pages in JWS, one per line, sending
+        them as they are produced.
+        """
+        def generate():
+            for obj in pages:
+                yield self._sign(obj) + '\n'
+        return Response(stream_with_context(generate()))
+
+    def _encode(self, obj, status=200, cacheable=False):
+        if getattr(g, 'unsigned', False):
+            # Part of a batch, which is signed as a whole.
+            resp = Response(status=status)
+            resp.payload = obj
+            return resp
+        return Response(self._sign(obj, cacheable), status=status)
 
     def cosigner(self, path, **kwargs):
         """Communicate with the cosigner server."""
-        if self._cosigner_server is None:
+        if self.cosigner_client is None:
             return None
+        return self.cosigner_client.call(path, **kwargs)
+
+    def replica(self, *writers):
+        """
+        Context manager routing the reads made with self.session to a
+        replica, unless one of writers (see note_write) changed data
+        recently enough that a replica might not have it yet.
+        """
+        routed = bool(self._dbcfg.get('replicas')) and not any(
+            self.store.get('wrote:{}'.format(writer)) for writer in writers)
+        return database.use_replica(self.session(), routed)
+
+    def note_write(self, *writers):
+        """Keep the reads of writers on the primary for a while."""
+        lag = self._dbcfg.get('replica_lag', 5)
+        if self._dbcfg.get('replicas') and lag:
+            for writer in writers:
+                self.store.set('wrote:{}'.format(writer), True, lag)
 
-        res = requests.post(
-            self._cosigner_server + path,
-            data=json.dumps(kwargs),
-            headers={'Content-Type': 'application/json'})
-        content = res.json()
-        return content
+    def use_shard(self, shard):
+        """Send the queries made with self.session to shard."""
+        if self.directory is not None:
+            self.session().info['shard'] = shard
 
-    def _sign(self, obj):
-        iat = time.time()
+    def locate_user(self, username):
+        """Select the shard of username, return False if it is unknown."""
+        if self.directory is None:
+            return True
+        shard = self.directory.user_shard(username)
+        if shard is None:
+            return False
+        self.use_shard(shard)
+        return True
+
+    def current_shard(self):
+        return self.session().info.get('shard', 0)
+
+    def verify(self, data, url):
+        """Validate and deserialize a JWS message received at url."""
+        if self.verifier is None:
+            return bitjws.validate_deserialize(data, requrl=url)
+        return self.verifier.run(bitjws.validate_deserialize, data, url)
+
+    def _sign(self, obj, cacheable=False):
         audience = request.base_url
-        signed = bitjws.sign_serialize(
-            self._privkey, requrl=audience, iat=iat, data=obj)
-        return signed
+        return self.signer.sign(obj, audience, cacheable)
 
     def _load_config(self, config):
         if ENVCFG in os.environ:
@@ -79,13 +175,20 @@ class Application(Flask):
         # Server key used to sign responses. The client can optionally
         # check that the response was signed by a key it knows to belong
         # to this server.
-        self._privkey = bitjws.PrivateKey(
-            bitjws.wif_to_privkey(self.config['api_signing_key']))
-        logging.info("Server key address: {}".format(
-            bitjws.pubkey_to_addr(self._privkey.pubkey.serialize())))
+        self.signer = Signer(self.config['api_signing_key'],
+                             **self.config.get('signer', {}))
+        logging.info("Server key address: {}".format(self.signer.address()))
+        metrics.register('sign_cache', self.signer.cache.stats)
 
-        self._cosigner_server = self.config.get('cosigner_server')
-        if not self._cosigner_server:
+        # cosigner_servers lists every instance when several run, the
+        # cosigner itself listens on cosigner_server.
+        cosigner_server = (self.config.get('cosigner_servers') or
+                           self.config.get('cosigner_server'))
+        if cosigner_server:
+            self.cosigner_client = CosignerClient(
+                cosigner_server, **self.config.get('cosigner_client', {}))
+            metrics.register('cosigner', self.cosigner_client.stats)
+        else:
             logging.warning("cosigner_server not present in config, "
                             "cosigning will not be available.")
 
@@ -95,22 +198,132 @@ class Application(Flask):
         if 'engine' not in self._dbcfg:
             raise Exception("Invalid config for api_databae: missing 'engine'")
 
+    def _setup_offload(self):
+        # Signature verification is CPU bound and would otherwise block
+        # every other greenlet in this worker while it runs.
+        cfg = self.config.get('verify_offload')
+        if cfg:
+            self.verifier = offload.Offload(**cfg)
+            metrics.register('verify_offload', self.verifier.stats)
+
     def _setup_auth(self):
+        # Public keys already authenticated by this worker, so most requests
+        # do not need to look them up again.
+        self.key_cache = LRUCache(**self.config.get('auth_cache', {}))
+        metrics.register('auth_cache', self.key_cache.stats)
+
         manager = LoginManager()
         manager.init_app(self)
         manager.request_loader(auth.authenticate)
         manager.unauthorized_handler(auth.unauthorized)
 
     def _setup_api(self):
-        engine = database.setup_engine(**self._dbcfg['engine'])
+        # Size the pools to the number of greenlets a worker runs at once.
+        pool = self._dbcfg.get('pool')
+        engine = database.setup_engine(pool, **self._dbcfg['engine'])
+        # Read-only queries may go to these, see Application.replica.
+        replicas = [database.setup_engine(pool, **cfg)
+                    for cfg in self._dbcfg.get('replicas', [])]
+        # Users are spread over these, the main engine then only holds
+        # the directory of which shard each user is on.
+        shards = [database.setup_engine(pool, **cfg)
+                  for cfg in self._dbcfg.get('shards', [])]
+        if replicas and shards:
+            raise Exception("Invalid config: replicas and shards cannot "
+                            "be combined")
+        self.engines = [engine] + replicas + shards
+        if shards:
+            self.directory = Directory(engine, len(shards))
         session_factory = database.session_factory(
-            engine, **self._dbcfg.get('session', {}))
+            engine, replicas, shards, **self._dbcfg.get('session', {}))
         # This is a scopped session, so each request handler will create
         # and destroy them as necessary.
         self.session = database.get_session(session_factory)
+        metrics.register('db_pool', engine.pool.status)
+
+        # State shared beyond a single request, either by this worker only
+        # or by every worker on this host, depending on its type.
+        self.store = store.from_config(self.config.get('local_store'))
+        self.nonce_guard = nonce.from_config(
+            self.session, shards or [engine], self.store,
+            self.config.get('nonce_guard'))
+
+        cfg = dict(self.config.get('balance_cache') or {})
+        if cfg:
+            shared = cfg.pop('shared', False)
+            self.balance_cache = LoadingCache(
+                self.store if shared else store.MemoryStore(), 'balance:',
+                **cfg)
+            metrics.register('balance_cache', self.balance_cache.stats)
+
+        cfg = dict(self.config.get('userdata_cache') or {})
+        self.userdata_negative_ttl = cfg.pop('negative_ttl', None)
+        self.userdata_cache = LRUCache(**cfg)
+        metrics.register('userdata_cache', self.userdata_cache.stats)
+
+        # Kept in the local store so writes made by any worker on this
+        # host wake the requests waiting in the others.
+        self.change_feed = ChangeFeed(
+            self.store, **self.config.get('change_feed', {}))
+
+        cfg = self.config.get('address_pool')
+        if cfg and self.cosigner_client is not None:
+            self.address_pool = AddressPool(self, **cfg)
+
+        cfg = self.config.get('join_jobs')
+        if cfg and self.cosigner_client is not None:
+            # Job states are kept in the local store so any worker on this
+            # host can report them.
+            self.join_jobs = JobRunner(self, self.store, **cfg)
 
         self.register_blueprint(user.blueprint)
         self.register_blueprint(serverwallet.blueprint)
+        self.register_blueprint(batch.blueprint)
+        if self.config.get('expose_metrics'):
+            self.register_blueprint(stats.blueprint)
+
+    def _setup_ratelimit(self):
+        cfg = dict(self.config.get('rate_limit') or {})
+        if not cfg:
+            return
+        shared = cfg.pop('shared', False)
+        # Number of reverse proxies in front of this server, the client IP
+        # is the address the outermost one saw.
+        self._proxies = cfg.pop('proxies', 0)
+        self.rate_limiter = RateLimiter(
+            self.store if shared else store.MemoryStore(), **cfg)
+        self.before_request(self._admit)
+
+    def _admit(self):
+        """Turn away clients over their rate limit before any real work."""
+        if self._proxies:
+            route = request.access_route
+            ip = route[max(len(route) - self._proxies, 0)]
+        else:
+            ip = request.remote_addr
+        kid = peek_kid(request.get_data()) if request.content_length else None
+        # The type is only known for keys in the cache, the others are
+        # held to the kid limit. The kid is not verified yet, so do not
+        # let it count as a cache hit or keep an entry around.
+        cached = self.key_cache.peek(kid) if kid else None
+        key_type = cached.key_type if cached is not None else None
+
+        g.rate_client = (ip, kid, key_type)
+        return self.throttle(request.path)
+
+    def throttle(self, path, batched=False):
+        """
+        Take a token for a call to path by the client of this request,
+        return a RateLimited error if it is over its limit. batched is
+        set for the operations of a /batch, see RateLimiter.allow.
+        """
+        if self.rate_limiter is None:
+            return None
+        ip, kid, key_type = g.rate_client
+        if not self.rate_limiter.allow(path, ip, kid, key_type, batched):
+            metrics.counter('rate_limited').inc()
+            return self.encode_error(Errors.RateLimited, 429)
+        return None
 
     def _shutdown_session(self, exception=None):
         if exception:
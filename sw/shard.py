@@ -0,0 +1,209 @@
+"""
+Horizontal sharding. Each user, along with their keys, blobs, cosigner
+wallets and addresses, lives on one of the api_database.shards databases.
+A directory kept in the main database (api_database.engine) maps
+usernames and public keys to their shard.
+
+To move a user to another shard, with the API stopped:
+
+    DEGLET_CONFIG=config/default.json python -m sw.shard move NAME SHARD
+"""
+import os
+import json
+import hashlib
+import argparse
+
+from sqlalchemy import Column, Integer, String, select
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.exc import IntegrityError
+
+from . import database as db
+
+__all__ = ['Directory', 'shard_for', 'move_user']
+
+DirectoryBase = declarative_base()
+
+
+class UserShard(DirectoryBase):
+    __tablename__ = 'user_shard'
+
+    username = Column(String, primary_key=True)
+    shard = Column(Integer, nullable=False)
+
+
+class KeyShard(DirectoryBase):
+    __tablename__ = 'key_shard'
+
+    key = Column(String, primary_key=True)
+    shard = Column(Integer, nullable=False)
+
+
+def shard_for(username, count):
+    """Shard where a new user is placed, a stable hash of the username."""
+    return int(hashlib.sha1(username).hexdigest(), 16) % count
+
+
+class Directory(object):
+
+    def __init__(self, engine, count):
+        self.engine = engine
+        self.count = count
+
+    def user_shard(self, username):
+        return self.engine.execute(select([UserShard.shard]).where(
+            UserShard.username == username)).scalar()
+
+    def key_shard(self, key):
+        return self.engine.execute(select([KeyShard.shard]).where(
+            KeyShard.key == key)).scalar()
+
+    def add_user(self, username, keys):
+        """
+        Place a new user and their keys. Return the shard, or None if the
+        username or one of the keys is already taken.
+        """
+        shard = shard_for(username, self.count)
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(UserShard.__table__.insert(),
+                             username=username, shard=shard)
+                conn.execute(KeyShard.__table__.insert(),
+                             [{'key': key, 'shard': shard} for key in keys])
+        except IntegrityError:
+            return None
+        return shard
+
+    def remove_user(self, username, keys):
+        with self.engine.begin() as conn:
+            conn.execute(UserShard.__table__.delete().where(
+                UserShard.username == username))
+            conn.execute(KeyShard.__table__.delete().where(
+                KeyShard.key.in_(keys)))
+
+    def set_shard(self, username, keys, shard):
+        with self.engine.begin() as conn:
+            conn.execute(UserShard.__table__.update().where(
+                UserShard.username == username).values(shard=shard))
+            conn.execute(KeyShard.__table__.update().where(
+                KeyShard.key.in_(keys)).values(shard=shard))
+
+
+def _copy(dst, table, rows, **values):
+    """Insert rows into dst without their id, return the new ids."""
+    ids = []
+    for row in rows:
+        data = dict(row)
+        data.pop('id')
+        data.update(values)
+        ids.append(dst.execute(table.insert(), data).inserted_primary_key[0])
+    return ids
+
+
+def _user_rows(engine, username):
+    """Return the rows of username in engine, or None if not there."""
+    user_t = db.User.__table__
+    key_t = db.UserKey.__table__
+    blob_t = db.WalletBlob.__table__
+    cowallet_t = db.CosignerWallet.__table__
+    address_t = db.CosignerAddress.__table__
+
+    user = engine.execute(select([user_t]).where(
+        user_t.c.username == username)).first()
+    if user is None:
+        return None
+    cowallets = engine.execute(select([cowallet_t]).where(
+        cowallet_t.c.user_id == user.id)).fetchall()
+    return {
+        'user': user,
+        'keys': engine.execute(select([key_t]).where(
+            key_t.c.user_id == user.id)).fetchall(),
+        'blobs': engine.execute(select([blob_t]).where(
+            blob_t.c.user_id == user.id)).fetchall(),
+        'cowallets': cowallets,
+        'addresses': engine.execute(select([address_t]).where(
+            address_t.c.cosigner_id.in_([row.id for row in cowallets]))
+        ).fetchall(),
+    }
+
+
+def _delete_user(engine, rows):
+    user_id = rows['user'].id
+    cowallet_ids = [row.id for row in rows['cowallets']]
+    with engine.begin() as conn:
+        conn.execute(db.CosignerAddress.__table__.delete().where(
+            db.CosignerAddress.cosigner_id.in_(cowallet_ids)))
+        conn.execute(db.CosignerWallet.__table__.delete().where(
+            db.CosignerWallet.user_id == user_id))
+        conn.execute(db.WalletBlob.__table__.delete().where(
+            db.WalletBlob.user_id == user_id))
+        conn.execute(db.UserKey.__table__.delete().where(
+            db.UserKey.user_id == user_id))
+        conn.execute(db.User.__table__.delete().where(
+            db.User.id == user_id))
+
+
+def move_user(directory, shards, username, target):
+    """
+    Copy a user and all their rows to the target shard, point the
+    directory at it and only then delete the rows from the old shard.
+
+    Every step can run again: the copy is a single transaction and is
+    skipped once the user is on the target, and the rows left on other
+    shards are deleted once the directory points at the target. A move
+    that stopped part way is finished by running it again.
+    """
+    source = directory.user_shard(username)
+    if source is None:
+        raise Exception("User {} not found".format(username))
+
+    moved = _user_rows(shards[target], username)
+    if moved is None:
+        rows = _user_rows(shards[source], username)
+        with shards[target].begin() as dst:
+            user_id = _copy(dst, db.User.__table__, [rows['user']])[0]
+            _copy(dst, db.UserKey.__table__, rows['keys'], user_id=user_id)
+            for row in rows['blobs']:
+                dst.execute(db.WalletBlob.__table__.insert(),
+                            dict(row, user_id=user_id))
+            new_ids = _copy(dst, db.CosignerWallet.__table__,
+                            rows['cowallets'], user_id=user_id)
+            remap = dict(zip([row.id for row in rows['cowallets']],
+                             new_ids))
+            for row in rows['addresses']:
+                _copy(dst, db.CosignerAddress.__table__, [row],
+                      cosigner_id=remap[row.cosigner_id])
+        moved = _user_rows(shards[target], username)
+
+    directory.set_shard(username, [row.key for row in moved['keys']],
+                        target)
+
+    for num, engine in enumerate(shards):
+        if num != target:
+            rows = _user_rows(engine, username)
+            if rows is not None:
+                _delete_user(engine, rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebalance user shards.')
+    sub = parser.add_subparsers(dest='command')
+    move = sub.add_parser('move', help='move a user to another shard')
+    move.add_argument('username')
+    move.add_argument('shard', type=int)
+    args = parser.parse_args()
+
+    configpath = os.getenv('DEGLET_CONFIG')
+    if not configpath:
+        raise Exception("DEGLET_CONFIG not specified in the environment")
+    dbcfg = json.load(open(configpath))['api_database']
+    shards = [db.setup_engine(**cfg) for cfg in dbcfg.get('shards', [])]
+    if args.shard < 0 or args.shard >= len(shards):
+        raise Exception("Invalid shard {}".format(args.shard))
+    directory = Directory(db.setup_engine(**dbcfg['engine']), len(shards))
+
+    move_user(directory, shards, args.username.encode('utf8'), args.shard)
+    print('Moved {} to shard {}'.format(args.username, args.shard))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Signing of the JWS responses sent by this server.
+"""
+import json
+import time
+
+import bitjws
+
+from . import metrics
+from .cache import LRUCache
+from .offload import Offload, PoolBusy
+
+__all__ = ['Signer']
+
+# Key used by a signing child process, see _load_key.
+_privkey = None
+
+
+def _load_key(wif):
+    global _privkey
+    _privkey = bitjws.PrivateKey(bitjws.wif_to_privkey(wif))
+
+
+def _sign_in_child(obj, audience, iat):
+    return bitjws.sign_serialize(_privkey, requrl=audience, iat=iat, data=obj)
+
+
+class Signer(object):
+    """
+    Sign response payloads with the server key.
+
+    The key, and the secp256k1 context it carries, is built once per
+    worker (and once per child process when signing is offloaded to
+    processes). Payloads marked as cacheable, like the fixed Errors.*
+    responses, are signed at most once per audience every cache_bucket
+    seconds.
+    """
+
+    def __init__(self, wif, offload=None, cache_size=1024, cache_bucket=1):
+        self.privkey = bitjws.PrivateKey(bitjws.wif_to_privkey(wif))
+        self.pool = None
+        if offload:
+            self.pool = Offload(initializer=_load_key, initargs=(wif,),
+                                **offload)
+        self.cache_bucket = cache_bucket
+        self.cache = LRUCache(cache_size, ttl=cache_bucket)
+
+    def sign(self, obj, audience, cacheable=False):
+        iat = time.time()
+        if not cacheable:
+            return self._sign(obj, audience, iat)
+
+        key = (json.dumps(obj, sort_keys=True), audience,
+               int(iat // self.cache_bucket))
+        signed = self.cache.get(key)
+        if signed is None:
+            signed = self._sign(obj, audience, iat)
+            self.cache.set(key, signed)
+        return signed
+
+    def _sign(self, obj, audience, iat):
+        with metrics.timed('sign.latency'):
+            if self.pool is not None:
+                try:
+                    return self._sign_offload(obj, audience, iat)
+                except PoolBusy:
+                    # Still answer, but in this greenlet.
+                    metrics.counter('sign.pool_busy').inc()
+            return self._sign_local(obj, audience, iat)
+
+    def _sign_offload(self, obj, audience, iat):
+        if self.pool.kind == 'process':
+            return self.pool.run(_sign_in_child, obj, audience, iat)
+        return self.pool.run(self._sign_local, obj, audience, iat)
+
+    def _sign_local(self, obj, audience, iat):
+        return bitjws.sign_serialize(
+            self.privkey, requrl=audience, iat=iat, data=obj)
+
+    def address(self):
+        return bitjws.pubkey_to_addr(self.privkey.pubkey.serialize())
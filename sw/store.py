@@ -0,0 +1,151 @@
+"""
+Key/value stores for state that must outlive a request. MemoryStore is
+private to a worker; SQLiteStore keeps the data in a local file so every
+worker on the same host shares it.
+"""
+import json
+import time
+import sqlite3
+import threading
+
+from .util import ProcessLocal
+
+__all__ = ['MemoryStore', 'SQLiteStore', 'from_config']
+
+
+class MemoryStore(object):
+    """
+    Expired entries are removed every PURGE_EVERY writes. Past max_size
+    entries, those closest to expiring are dropped until a tenth of the
+    room is free again.
+    """
+
+    # Expired entries are removed every this many writes.
+    PURGE_EVERY = 1000
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._data = {}
+        self._writes = 0
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or (entry[0] and entry[0] <= time.time()):
+            return default
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._writes += 1
+            if (self._writes % self.PURGE_EVERY == 0 or
+                    len(self._data) > self.max_size):
+                self._purge()
+
+    def _purge(self):
+        now = time.time()
+        for key in [key for key, (expires, _) in self._data.items()
+                    if expires and expires <= now]:
+            del self._data[key]
+        if len(self._data) > self.max_size:
+            excess = len(self._data) - self.max_size * 9 // 10
+            # Entries that never expire go last.
+            oldest = sorted(self._data.items(),
+                            key=lambda item: item[1][0] or float('inf'))
+            for key, _ in oldest[:excess]:
+                del self._data[key]
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def update(self, key, func, ttl=None):
+        """
+        Atomically replace the value for key with the first item of
+        func(current) and return the second one. current is None when
+        key is not present.
+        """
+        with self._lock:
+            value, result = func(self.get(key))
+            self.set(key, value, ttl)
+        return result
+
+
+class SQLiteStore(object):
+
+    # Expired rows are removed every this many writes.
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._conn = ProcessLocal(self._open)
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS kv ('
+                     'key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        return conn
+
+    def _connect(self):
+        return self._conn.get()
+
+    def _read(self, conn, key):
+        row = conn.execute('SELECT value, expires FROM kv WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None or (row[1] and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def _write(self, conn, key, value, ttl):
+        expires = time.time() + ttl if ttl else None
+        conn.execute('INSERT OR REPLACE INTO kv VALUES (?, ?, ?)',
+                     (key, json.dumps(value), expires))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute('DELETE FROM kv WHERE expires <= ?', (time.time(),))
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._read(self._connect(), key)
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._write(self._connect(), key, value, ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._connect().execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def update(self, key, func, ttl=None):
+        """See MemoryStore.update."""
+        with self._lock:
+            conn = self._connect()
+            # Take the write lock up front so no other process can
+            # interleave between the read and the write.
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                value, result = func(self._read(conn, key))
+                self._write(conn, key, value, ttl)
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        return result
+
+
+def from_config(cfg=None):
+    """Build a store from a config like {"type": "sqlite", "path": ...}."""
+    cfg = dict(cfg or {})
+    kind = cfg.pop('type', 'memory')
+    if kind == 'memory':
+        return MemoryStore(**cfg)
+    elif kind == 'sqlite':
+        return SQLiteStore(**cfg)
+    raise Exception("Invalid config: unknown store type {}".format(kind))
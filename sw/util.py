@@ -1,4 +1,8 @@
+import os
 import math
+import resource
+import threading
+from multiprocessing.pool import ThreadPool
 
 
 def entropy(hexstring, bits=128, raw=False):
@@ -19,6 +23,69 @@ def entropy(hexstring, bits=128, raw=False):
     return entropy
 
 
+def concurrent_map(func, items, size):
+    """
+    Return [func(item) for item in items] while running up to size calls
+    at once: in greenlets when gevent has patched the worker, in threads
+    otherwise.
+    """
+    try:
+        from gevent import monkey
+        from gevent.pool import Pool
+        patched = monkey.is_module_patched('socket')
+    except ImportError:
+        patched = False
+
+    if patched:
+        return Pool(size).map(func, items)
+    pool = ThreadPool(size)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+
+class ProcessLocal(object):
+    """
+    A value made by factory() for the process that uses it. Threads,
+    sockets and child processes do not survive a fork, so a process
+    forked from the one that made the value, like a gunicorn worker from
+    a preloading master, makes its own on first use.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._value = self.factory()
+                    self._pid = pid
+        return self._value
+
+
+def memory_usage():
+    """
+    Describe the memory used by this process: its resident set and, on
+    Linux, how much of it is shared with other processes (such as the
+    pages a forked worker still shares with its master).
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            rss, shared = [int(field) for field in statm.read().split()[1:3]]
+    except IOError:
+        # ru_maxrss is in kilobytes on Linux, bytes on OS X.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return 'peak RSS {}'.format(peak)
+    page = os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0
+    return 'RSS {:.1f} MB, {:.1f} MB shared'.format(rss * page, shared * page)
+
+
 if __name__ == "__main__":
     t1 = '58e1ac7b7faf79e6ee24230f40b4a9ae'
     ent1 = entropy(t1)
@@ -0,0 +1,114 @@
+"""
+Measure how long requests wait for their JWS check (Application.verify)
+with and without verify_offload, at several levels of concurrency.
+
+    python -m sw.verifybench [--requests 500] [--clients 1 10 100]
+
+Clients are greenlets, as in a gevent worker: without offload a check
+holds the hub, so every other client waits for it. The hub lag is how
+late a 10 ms timer fires meanwhile, the delay any other request of the
+worker would see.
+"""
+import time
+import argparse
+
+import bitjws
+import gevent
+from gevent.pool import Pool
+
+from . import metrics
+from .offload import PoolBusy
+from .server import Application
+
+URL = 'http://localhost/user'
+
+
+def build(offload):
+    key = bitjws.PrivateKey()
+    return Application({
+        'api_signing_key': bitjws.privkey_to_wif(key.private_key),
+        'api_database': {'engine': {'name_or_url': 'sqlite://'}},
+        'local_store': {'type': 'memory'},
+        'verify_offload': offload})
+
+
+def messages(count):
+    key = bitjws.PrivateKey()
+    return [bitjws.sign_serialize(key, requrl=URL, iat=num, count=1)
+            for num in range(count)]
+
+
+def run(app, msgs, clients, requests):
+    """
+    Verify requests messages from clients greenlets. Return histograms
+    of the request and hub latencies, the number of checks refused with
+    PoolBusy and the time taken.
+    """
+    latency = metrics.Histogram()
+    lag = metrics.Histogram()
+    state = {'sent': 0, 'busy': 0}
+
+    def client():
+        while state['sent'] < requests:
+            msg = msgs[state['sent'] % len(msgs)]
+            state['sent'] += 1
+            start = time.time()
+            # Reading the request: wait on the hub, as for a socket.
+            gevent.sleep(0.001)
+            try:
+                header, payload = app.verify(msg, URL)
+            except PoolBusy:
+                state['busy'] += 1
+                continue
+            latency.observe(time.time() - start)
+            if header is None:
+                raise Exception("Verification failed")
+
+    def ticker():
+        while True:
+            start = time.time()
+            gevent.sleep(0.01)
+            lag.observe(time.time() - start - 0.01)
+
+    pool = Pool(clients)
+    tick = gevent.spawn(ticker)
+    start = time.time()
+    for _ in range(clients):
+        pool.spawn(client)
+    pool.join(raise_error=True)
+    elapsed = time.time() - start
+    tick.kill()
+    return latency, lag, state['busy'], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark JWS checks.')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='messages verified per run')
+    parser.add_argument('--clients', type=int, nargs='+',
+                        default=[1, 10, 100], help='concurrent clients')
+    parser.add_argument('--kind', default='thread',
+                        choices=['thread', 'process'])
+    parser.add_argument('--size', type=int, default=4,
+                        help='offload threads or processes')
+    parser.add_argument('--max-pending', type=int, default=64)
+    args = parser.parse_args()
+
+    offload = {'kind': args.kind, 'size': args.size,
+               'max_pending': args.max_pending, 'timeout': 5}
+    msgs = messages(100)
+    for name, cfg in (('inline', None), ('offload', offload)):
+        app = build(cfg)
+        for clients in args.clients:
+            latency, lag, busy, elapsed = run(app, msgs, clients,
+                                              args.requests)
+            print('{:8} {:4d} clients: p50 {} s, p99 {} s, hub lag p99 {} s,'
+                  ' {:.0f} checks/s{}'.format(
+                      name, clients, latency.quantile(0.5),
+                      latency.quantile(0.99), lag.quantile(0.99),
+                      latency.count / elapsed,
+                      ', {} busy'.format(busy) if busy else ''))
+
+
+if __name__ == "__main__":
+    main()
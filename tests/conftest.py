@@ -0,0 +1,75 @@
+import os
+import time
+import binascii
+
+import bitjws
+import pytest
+
+from sw import database as db
+from sw.server import Application
+
+def make_config(tmpdir, **extra):
+    """Config for an Application on SQLite files kept in tmpdir."""
+    key = bitjws.PrivateKey()
+    cfg = {
+        'api_signing_key': bitjws.privkey_to_wif(key.private_key),
+        'api_database': {'engine': {
+            'name_or_url': 'sqlite:///{}'.format(tmpdir.join('api.db'))}},
+        'local_store': {'type': 'memory'},
+    }
+    cfg.update(extra)
+    return cfg
+
+
+def make_app(cfg):
+    os.environ.pop('DEGLET_CONFIG', None)
+    app = Application(cfg)
+    if app.directory is not None:
+        from sw.shard import DirectoryBase
+        DirectoryBase.metadata.create_all(app.engines[0])
+        for engine in app.engines[1:]:
+            db.Base.metadata.create_all(engine)
+    else:
+        db.Base.metadata.create_all(app.engines[0])
+    return app
+
+
+@pytest.fixture
+def app(tmpdir):
+    return make_app(make_config(tmpdir))
+
+
+class Client(object):
+    """Send requests signed with key and decode the signed responses."""
+
+    def __init__(self, app, key=None):
+        self.key = key or bitjws.PrivateKey()
+        self.http = app.test_client()
+        self.nonce = int(time.time() * 1000)
+
+    @property
+    def address(self):
+        return bitjws.pubkey_to_addr(self.key.pubkey.serialize())
+
+    def _send(self, path, data):
+        self.nonce += 1
+        url = 'http://localhost' + path
+        msg = bitjws.sign_serialize(self.key, requrl=url, iat=self.nonce,
+                                    **data)
+        return url, self.http.post(path, data=msg)
+
+    def post(self, path, **data):
+        url, resp = self._send(path, data)
+        _, payload = bitjws.validate_deserialize(resp.get_data(), requrl=url)
+        return resp.status_code, payload['data']
+
+    def stream(self, path, **data):
+        """Return the data of each page of a streamed response."""
+        url, resp = self._send(path, data)
+        return [bitjws.validate_deserialize(line, requrl=url)[1]['data']
+                for line in resp.get_data().splitlines()]
+
+    def signup(self, username):
+        return self.post('/user/signup', username=username, check='abcdef',
+                         salt=binascii.hexlify(os.urandom(16)),
+                         iterations=10000)
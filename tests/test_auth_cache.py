@@ -0,0 +1,41 @@
+import datetime
+
+from sw import database as db
+from sw.error import Errors
+
+from conftest import Client, make_app, make_config
+
+
+def test_bulk_deactivation_drops_cached_keys(app):
+    client = Client(app)
+    assert client.signup('alice') == (200, None)
+    assert client.post('/user')[0] == 200
+    assert len(app.key_cache) == 1
+
+    with app.app_context():
+        session = app.session()
+        # Counters are not cached, changing them keeps the entries.
+        session.query(db.User).update(
+            {'blob_count': db.User.blob_count + 0},
+            synchronize_session=False)
+        assert len(app.key_cache) == 1
+        session.query(db.UserKey).filter(
+            db.UserKey.key == client.address).update(
+                {'deactivated_at': datetime.datetime.utcnow()},
+                synchronize_session=False)
+        session.commit()
+        app.session.remove()
+
+    status, data = client.post('/user')
+    assert status == 401
+    assert data['code'] == Errors.UserNotFound.code
+
+
+def test_apps_do_not_add_listeners(tmpdir, app):
+    def listeners():
+        return (len(db.UserKey.__mapper__.dispatch.after_update) +
+                len(db.User.__mapper__.dispatch.after_update))
+
+    before = listeners()
+    make_app(make_config(tmpdir.mkdir('other')))
+    assert listeners() == before
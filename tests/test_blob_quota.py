@@ -0,0 +1,58 @@
+import threading
+
+from sw import database as db
+from sw.error import Errors
+from sw.constant import MAX_BLOBCOUNT
+
+from conftest import Client
+
+
+def blob_id(num):
+    return '{:08d}-0000-0000-0000-000000000000'.format(num)
+
+
+def test_quota_holds_under_parallel_uploads(app):
+    owner = Client(app)
+    assert owner.signup('alice') == (200, None)
+
+    # Every thread signs with its own key of the same user, so their
+    # nonces do not race each other.
+    session = app.session()
+    user = session.query(db.User).filter(db.User.username == 'alice').one()
+    clients = [Client(app) for _ in range(MAX_BLOBCOUNT * 3)]
+    session.add_all(db.UserKey(user=user, key=client.address, last_nonce=0,
+                               key_type=db.KeyType.publickey.name)
+                    for client in clients)
+    session.commit()
+    user_id = user.id
+    app.session.remove()
+
+    start = threading.Event()
+    results = []
+
+    def upload(client, num):
+        start.wait()
+        results.append(client.post('/user/blob', id=blob_id(num),
+                                   blob='wallet {}'.format(num)))
+
+    threads = [threading.Thread(target=upload, args=(client, num))
+               for num, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+
+    stored = [data for status, data in results if status == 200]
+    refused = [data for status, data in results
+               if status != 200 and data['code'] == Errors.TooManyBlobs.code]
+    assert len(stored) == MAX_BLOBCOUNT
+    assert len(refused) == len(clients) - MAX_BLOBCOUNT
+
+    engine = app.engines[0]
+    rows = engine.execute(db.WalletBlob.__table__.select().where(
+        db.WalletBlob.user_id == user_id)).fetchall()
+    count = engine.execute(db.User.__table__.select().where(
+        db.User.id == user_id)).first().blob_count
+    assert len(rows) == MAX_BLOBCOUNT
+    assert count == MAX_BLOBCOUNT
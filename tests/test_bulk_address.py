@@ -0,0 +1,86 @@
+from sw import database as db
+
+from conftest import Client
+
+
+class Cosigner(object):
+    """Derives addresses in path order, like the cosigner server."""
+
+    def __init__(self, start):
+        self.next = start
+        self.calls = 0
+
+    def call(self, path, num, wallet):
+        assert path == '/address/new'
+        self.calls += 1
+        derived = [{'address': 'addr{}'.format(index),
+                    'path': 'm/0/{}'.format(index), 'createdOn': 1}
+                   for index in range(self.next, self.next + num)]
+        self.next += num
+        return {'address': derived}
+
+
+def setup_wallet(app, username, pooled):
+    client = Client(app)
+    assert client.signup(username) == (200, None)
+    session = app.session()
+    user = session.query(db.User).filter(db.User.username == username).one()
+    record = db.CosignerWallet(user_id=user.id, wallet_id='w1',
+                               wallet=b'{}')
+    session.add(record)
+    session.flush()
+    session.add_all(db.CosignerAddress(
+        cosigner_id=record.id, address='addr{}'.format(index),
+        path='m/0/{}'.format(index), path_index=index)
+        for index in range(pooled))
+    session.commit()
+    app.session.remove()
+    app.cosigner_client = Cosigner(pooled)
+    return client
+
+
+def addresses(pages):
+    return [entry['address'] for page in pages for entry in page['result']]
+
+
+def test_bulk_skips_addresses_issued_elsewhere(app):
+    client = setup_wallet(app, 'alice', 6)
+    # Taken by /address from the pool before the stream starts.
+    session = app.session()
+    session.query(db.CosignerAddress).filter(
+        db.CosignerAddress.path_index == 1).update(
+            {'issued_at': db.func.now(), 'claim': 'other'},
+            synchronize_session=False)
+    session.commit()
+    app.session.remove()
+
+    pages = client.stream('/address/bulk', id='w1', num=7, page=3)
+    assert addresses(pages) == ['addr0', 'addr2', 'addr3', 'addr4', 'addr5',
+                                'addr6', 'addr7']
+    assert [page['remaining'] for page in pages] == [4, 1, 0]
+
+    # A second stream gets none of them.
+    other = client.stream('/address/bulk', id='w1', num=2)
+    assert addresses(other) == ['addr8', 'addr9']
+    assert other[0]['stream'] != pages[0]['stream']
+
+
+def test_bulk_resume_replays_only_its_stream(app):
+    client = setup_wallet(app, 'bob', 4)
+    first = client.stream('/address/bulk', id='w1', num=6, page=2)
+    assert addresses(first) == ['addr{}'.format(i) for i in range(6)]
+    stream = first[0]['stream']
+    # Meanwhile another request takes the next addresses.
+    assert addresses(client.stream('/address/bulk', id='w1', num=2)) == [
+        'addr6', 'addr7']
+
+    calls = app.cosigner_client.calls
+    resumed = client.stream('/address/bulk', id='w1', num=4, page=2,
+                            stream=stream, after=first[0]['cursor'])
+    assert addresses(resumed) == ['addr2', 'addr3', 'addr4', 'addr5']
+    assert app.cosigner_client.calls == calls
+
+    # Past what it had, the resumed stream claims new addresses.
+    more = client.stream('/address/bulk', id='w1', num=1, stream=stream,
+                         after=resumed[-1]['cursor'])
+    assert addresses(more) == ['addr8']
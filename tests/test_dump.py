@@ -0,0 +1,69 @@
+from sqlalchemy import create_engine, select
+
+from sw import database as db
+from sw.dump import export, restore, TABLES, DIRECTORY_TABLES
+from sw.shard import DirectoryBase
+
+from conftest import Client, make_app, make_config
+
+
+def rows(engine, tables):
+    return dict((table.name, engine.execute(
+        select([table]).order_by(*table.primary_key.columns)).fetchall())
+                for table in tables)
+
+
+def fill(app, users):
+    for num in range(users):
+        client = Client(app)
+        assert client.signup('user{}'.format(num)) == (200, None)
+        blob_id = '{:08d}-0000-0000-0000-000000000000'.format(num)
+        assert client.post('/user/blob', id=blob_id,
+                           blob='{"ct": "%s"}' % ('x' * 300))[0] == 200
+
+
+def test_export_resumes_and_imports(app, tmpdir):
+    fill(app, 5)
+    source = app.engines[0]
+    session = app.session()
+    session.add(db.CosignerWallet(user_id=1, wallet_id='w', wallet=b'{}'))
+    session.flush()
+    session.add(db.CosignerAddress(cosigner_id=1, address='a', path='m/0/0',
+                                   path_index=0))
+    session.commit()
+    app.session.remove()
+
+    path = str(tmpdir.join('dump'))
+    assert export(source, path, chunk=2) == 17
+    # Cut the file inside its last chunk, as an interrupted run would.
+    with open(path, 'rb+') as out:
+        out.seek(-3, 2)
+        out.truncate()
+    export(source, path, chunk=2)
+
+    target = create_engine('sqlite:///{}'.format(tmpdir.join('copy.db')))
+    db.Base.metadata.create_all(target)
+    assert restore(target, path) == 17
+    assert rows(target, TABLES) == rows(source, TABLES)
+    # Importing again finds every chunk in place.
+    assert restore(target, path) == 0
+
+
+def test_export_directory(tmpdir):
+    dbcfg = {
+        'engine': {'name_or_url': 'sqlite:///{}'.format(
+            tmpdir.join('directory.db'))},
+        'shards': [{'name_or_url': 'sqlite:///{}'.format(
+            tmpdir.join('shard{}.db'.format(num)))} for num in range(2)]
+    }
+    app = make_app(make_config(tmpdir, api_database=dbcfg))
+    fill(app, 4)
+    source = app.engines[0]
+
+    path = str(tmpdir.join('dump'))
+    assert export(source, path, tables=DIRECTORY_TABLES) == 8
+    target = create_engine('sqlite:///{}'.format(tmpdir.join('copy.db')))
+    DirectoryBase.metadata.create_all(target)
+    assert restore(target, path) == 8
+    assert (rows(target, DIRECTORY_TABLES) ==
+            rows(source, DIRECTORY_TABLES))
@@ -0,0 +1,31 @@
+from sw.error import Errors
+from sw.store import SQLiteStore
+
+from conftest import Client, make_app, make_config
+
+
+class ExpiringStore(SQLiteStore):
+    """Drops every nonce entry just before updating it, as if it expired."""
+
+    def update(self, key, func, ttl=None):
+        self.delete(key)
+        return super(ExpiringStore, self).update(key, func, ttl)
+
+
+def test_expired_entry_does_not_allow_a_replay(tmpdir):
+    app = make_app(make_config(
+        tmpdir, nonce_guard={'type': 'store'},
+        local_store={'type': 'sqlite', 'path': str(tmpdir.join('kv.db'))}))
+    client = Client(app)
+    assert client.signup('alice') == (200, None)
+    assert client.post('/user')[0] == 200
+    used = client.nonce
+    # The accepted nonce reaches user_key, then the entry goes away.
+    app.nonce_guard.flush()
+    app.nonce_guard.store = ExpiringStore(str(tmpdir.join('kv.db')))
+
+    client.nonce = used - 1
+    status, data = client.post('/user')
+    assert status == 401
+    assert data['code'] == Errors.InvalidNonce.code
+    assert client.post('/user')[0] == 200
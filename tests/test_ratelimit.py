@@ -0,0 +1,35 @@
+from sw.store import MemoryStore
+from sw.ratelimit import RateLimiter
+
+SLOW = {'rate': 0.001, 'burst': 2}
+
+
+def tokens(store, name):
+    return int(store.get('rate:' + name)[0])
+
+
+def test_refused_request_does_not_drain_other_buckets():
+    store = MemoryStore()
+    limiter = RateLimiter(store, ip={'rate': 0.001, 'burst': 10},
+                          kid={'rate': 0.001, 'burst': 10},
+                          endpoints={'/address': SLOW})
+    assert limiter.allow('/address', '1.2.3.4', 'k')
+    assert limiter.allow('/address', '1.2.3.4', 'k')
+    for _ in range(5):
+        assert not limiter.allow('/address', '1.2.3.4', 'k')
+    assert tokens(store, 'ip:1.2.3.4') == 8
+    assert tokens(store, 'kid:k') == 8
+
+
+def test_batched_operations_only_charge_their_path():
+    store = MemoryStore()
+    limiter = RateLimiter(store, ip={'rate': 0.001, 'burst': 10},
+                          kid={'rate': 0.001, 'burst': 10},
+                          endpoints={'/address': SLOW})
+    assert limiter.allow('/batch', '1.2.3.4', 'k')
+    assert limiter.allow('/balance', '1.2.3.4', 'k', batched=True)
+    assert limiter.allow('/address', '1.2.3.4', 'k', batched=True)
+    assert limiter.allow('/address', '1.2.3.4', 'k', batched=True)
+    assert not limiter.allow('/address', '1.2.3.4', 'k', batched=True)
+    assert tokens(store, 'ip:1.2.3.4') == 9
+    assert tokens(store, 'kid:k') == 9
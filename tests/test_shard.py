@@ -0,0 +1,173 @@
+import pytest
+from sqlalchemy import select, func
+
+from sw import database as db
+from sw import shard
+from sw.auth import lookup_key
+from sw.shard import shard_for, move_user
+
+from conftest import Client, make_app, make_config
+
+SHARDS = 3
+
+
+@pytest.fixture
+def app(tmpdir):
+    dbcfg = {
+        'engine': {'name_or_url': 'sqlite:///{}'.format(
+            tmpdir.join('directory.db'))},
+        'shards': [{'name_or_url': 'sqlite:///{}'.format(
+            tmpdir.join('shard{}.db'.format(num)))}
+            for num in range(SHARDS)]
+    }
+    return make_app(make_config(tmpdir, api_database=dbcfg))
+
+
+def shard_engines(app):
+    return app.engines[1:]
+
+
+def count(engine, table, *where):
+    query = select([func.count()]).select_from(table.__table__)
+    for clause in where:
+        query = query.where(clause)
+    return engine.execute(query).scalar()
+
+
+def test_signup_places_user_by_username(app):
+    names = ['user{}'.format(num) for num in range(12)]
+    clients = {}
+    for name in names:
+        clients[name] = Client(app)
+        assert clients[name].signup(name) == (200, None)
+
+    engines = shard_engines(app)
+    placed = set()
+    for name in names:
+        shard = shard_for(name, SHARDS)
+        placed.add(shard)
+        assert app.directory.user_shard(name) == shard
+        assert app.directory.key_shard(clients[name].address) == shard
+        for num, engine in enumerate(engines):
+            found = count(engine, db.User, db.User.username == name)
+            assert found == (1 if num == shard else 0)
+    # Twelve names are enough to use every shard.
+    assert placed == set(range(SHARDS))
+
+    # A username stays taken across shards.
+    status, data = Client(app).signup(names[0])
+    assert data['code'] == 902
+
+
+def test_lookup_key_goes_through_directory(app):
+    client = Client(app)
+    assert client.signup('carol') == (200, None)
+    shard = shard_for('carol', SHARDS)
+
+    with app.test_request_context():
+        entry = lookup_key(client.address)
+        assert entry.username == 'carol'
+        assert entry.shard == shard
+        assert app.current_shard() == shard
+        assert lookup_key(Client(app).address) is None
+    app.session.remove()
+
+    # Authenticated requests land on the user's shard.
+    status, data = client.post('/user', count=1)
+    assert (status, data) == (200, {'num': 0})
+
+
+def test_move_user_copies_rows_and_repoints_directory(app):
+    client = Client(app)
+    assert client.signup('dave') == (200, None)
+    blob_id = '00000000-0000-0000-0000-000000000001'
+    status, _ = client.post('/user/blob', id=blob_id, blob='wallet')
+    assert status == 200
+
+    engines = shard_engines(app)
+    source = shard_for('dave', SHARDS)
+    target = (source + 1) % SHARDS
+    src, dst = engines[source], engines[target]
+
+    # Give the target shard a user of its own, so ids differ there.
+    other = Client(app)
+    for num in range(SHARDS * 10):
+        name = 'other{}'.format(num)
+        if shard_for(name, SHARDS) == target:
+            assert other.signup(name) == (200, None)
+            break
+
+    user_id = src.execute(select([db.User.id]).where(
+        db.User.username == 'dave')).scalar()
+    wallet_id = src.execute(db.CosignerWallet.__table__.insert(), {
+        'user_id': user_id, 'wallet_id': blob_id,
+        'wallet': b'credentials'}).inserted_primary_key[0]
+    src.execute(db.CosignerAddress.__table__.insert(), [
+        {'cosigner_id': wallet_id, 'address': 'addr{}'.format(num),
+         'path': 'm/0/{}'.format(num), 'path_index': num}
+        for num in range(3)])
+
+    move_user(app.directory, engines, 'dave', target)
+
+    assert app.directory.user_shard('dave') == target
+    assert app.directory.key_shard(client.address) == target
+
+    new_id = dst.execute(select([db.User.id]).where(
+        db.User.username == 'dave')).scalar()
+    assert new_id is not None
+    assert count(dst, db.UserKey, db.UserKey.user_id == new_id,
+                 db.UserKey.key == client.address) == 1
+    blob = dst.execute(db.WalletBlob.__table__.select().where(
+        db.WalletBlob.user_id == new_id)).first()
+    assert blob.id == blob_id
+    cowallet = dst.execute(db.CosignerWallet.__table__.select().where(
+        db.CosignerWallet.user_id == new_id)).first()
+    assert cowallet.wallet_id == blob_id
+    assert cowallet.wallet == b'credentials'
+    paths = [row.path for row in dst.execute(
+        db.CosignerAddress.__table__.select().where(
+            db.CosignerAddress.cosigner_id == cowallet.id).order_by(
+                db.CosignerAddress.path_index))]
+    assert paths == ['m/0/0', 'm/0/1', 'm/0/2']
+
+    for table in (db.User, db.UserKey, db.WalletBlob, db.CosignerWallet,
+                  db.CosignerAddress):
+        assert count(src, table) == 0
+
+    # The cached key still points at the old shard.
+    app.key_cache.clear()
+    status, data = client.post('/user')
+    assert status == 200
+    assert [entry['id'] for entry in data] == [blob_id]
+
+
+@pytest.mark.parametrize('step', ['set_shard', 'delete'])
+def test_interrupted_move_finishes_when_run_again(app, monkeypatch, step):
+    client = Client(app)
+    assert client.signup('erin') == (200, None)
+    engines = shard_engines(app)
+    source = shard_for('erin', SHARDS)
+    target = (source + 1) % SHARDS
+
+    if step == 'set_shard':
+        monkeypatch.setattr(shard.Directory, 'set_shard', crash)
+    else:
+        monkeypatch.setattr(shard, '_delete_user', crash)
+    with pytest.raises(RuntimeError):
+        move_user(app.directory, engines, 'erin', target)
+    monkeypatch.undo()
+
+    move_user(app.directory, engines, 'erin', target)
+    move_user(app.directory, engines, 'erin', target)
+
+    assert app.directory.user_shard('erin') == target
+    assert app.directory.key_shard(client.address) == target
+    for num, engine in enumerate(engines):
+        users = 1 if num == target else 0
+        assert count(engine, db.User, db.User.username == 'erin') == users
+        assert count(engine, db.UserKey,
+                     db.UserKey.key == client.address) == users
+
+
+def crash(*args, **kwargs):
+    raise RuntimeError("crashed")